@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from cytomineprojectmigrator.fingerprint import file_digest
+from cytomineprojectmigrator.reader import iter_json_array
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+ARCHIVE_VERSION = 2
+MANIFEST = "manifest.json"
+METADATA_DIRECTORY = "metadata"
+
+# Record types consolidated into JSON-lines shards (one record per line).
+SHARDED_TYPES = ("properties", "attached-files", "description")
+
+
+class ArchiveWriter:
+    """
+    Write the records of an exported project. Each record type is registered in a manifest with its files,
+    record counts and checksums. Metadata records are appended to a few JSON-lines shards instead of one small
+    file per object.
+    """
+    def __init__(self, project_path, shard_size=100000):
+        self.project_path = project_path
+        self.shard_size = shard_size
+
+        self._lock = threading.Lock()
+        self._records = OrderedDict()
+        self._current_shard = {}
+        self._handles = {}
+
+    def _register(self, record_type, filename, count):
+        shards = self._records.setdefault(record_type, OrderedDict())
+        shard = shards.setdefault(filename, {"file": filename, "count": 0})
+        shard["count"] += count
+
+    def save(self, record_type, filename, content, count=1):
+        """Write a whole JSON file for a record type."""
+        with io.open(os.path.join(self.project_path, filename), "w", encoding="utf-8") as outfile:
+            outfile.write(content)
+        with self._lock:
+            self._register(record_type, filename, count)
+
+    def append(self, record_type, records):
+        """Append records (dicts) to the current shard of a record type."""
+        with self._lock:
+            filename, count = self._current_shard.get(record_type, (None, 0))
+            for record in records:
+                if filename is None or count >= self.shard_size:
+                    filename = self._new_shard(record_type)
+                    count = 0
+
+                handle = self._handles[record_type]
+                handle.write(json.dumps(record))
+                handle.write("\n")
+                self._register(record_type, filename, 1)
+                count += 1
+            self._current_shard[record_type] = (filename, count)
+
+    def _new_shard(self, record_type):
+        if record_type in self._handles:
+            self._handles.pop(record_type).close()
+
+        directory = os.path.join(self.project_path, METADATA_DIRECTORY)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        index = len(self._records.get(record_type, {}))
+        filename = os.path.join(METADATA_DIRECTORY, "{}-{:04d}.jsonl".format(record_type, index))
+        self._handles[record_type] = io.open(os.path.join(self.project_path, filename), "a", encoding="utf-8")
+        self._register(record_type, filename, 0)
+        return filename
+
+    def close(self):
+        """Compute the checksums and write the manifest."""
+        with self._lock:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles = {}
+            self._current_shard = {}
+
+        records = OrderedDict()
+        for record_type, shards in self._records.items():
+            shards = list(shards.values())
+            for shard in shards:
+                shard["sha256"] = file_digest(os.path.join(self.project_path, shard["file"]))
+            records[record_type] = {
+                "format": "jsonl" if record_type in SHARDED_TYPES else "json",
+                "count": sum(shard["count"] for shard in shards),
+                "shards": shards
+            }
+
+        manifest = OrderedDict([("version", ARCHIVE_VERSION), ("records", records)])
+        with open(os.path.join(self.project_path, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+        logging.info("Archive manifest written ({} record types).".format(len(records)))
+
+
+class ArchiveReader:
+    """
+    Read the records of an exported project, either from the manifest (direct access to the shard files of a
+    record type) or, for archives without manifest, by matching file name prefixes of a single directory listing.
+    """
+    def __init__(self, working_path):
+        self.working_path = working_path
+        self.manifest = None
+        self._listing = None
+
+        manifest_path = os.path.join(working_path, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest.get("version", 0) > ARCHIVE_VERSION:
+                raise ValueError("Unsupported archive version {}".format(self.manifest.get("version")))
+        else:
+            self._listing = sorted(f for f in os.listdir(working_path) if f.endswith(".json"))
+
+    @property
+    def version(self):
+        return self.manifest["version"] if self.manifest else 1
+
+    def files(self, record_type):
+        """Files (relative to the working path) holding the records of the types starting with `record_type`."""
+        if self.manifest:
+            return [shard["file"] for name, record in self.manifest["records"].items() if name.startswith(record_type)
+                    for shard in record["shards"]]
+        return [f for f in self._listing if f.startswith(record_type)]
+
+    def records(self, record_type):
+        """Iterate over the records (dicts) of the given type."""
+        for filename in self.files(record_type):
+            path = os.path.join(self.working_path, filename)
+            if filename.endswith(".jsonl"):
+                with io.open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            yield json.loads(line)
+            else:
+                with io.open(path, "r", encoding="utf-8") as f:
+                    first = f.read(1)
+                    while first and first.isspace():
+                        first = f.read(1)
+                if first == "[":
+                    for record in iter_json_array(path):
+                        yield record
+                elif first:
+                    with io.open(path, "r", encoding="utf-8") as f:
+                        yield json.load(f)
+
+    def count(self, record_type):
+        if self.manifest:
+            return sum(record["count"] for name, record in self.manifest["records"].items()
+                       if name.startswith(record_type))
+        return sum(1 for _ in self.records(record_type))
+
+    def verify(self):
+        """Check the checksums of all the files listed in the manifest."""
+        if not self.manifest:
+            return
+        for record_type, record in self.manifest["records"].items():
+            for shard in record["shards"]:
+                digest = file_digest(os.path.join(self.working_path, shard["file"]))
+                if digest != shard.get("sha256", digest):
+                    raise ValueError("Checksum mismatch for {} ({})".format(shard["file"], record_type))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import logging
+import time
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+def expand_items(values):
+    """
+    Expand command line values into a list of items to process. A value ending with `.txt` is a file listing one
+    item per line (empty lines and lines starting with `#` are skipped).
+    """
+    items = []
+    for value in values:
+        if value.endswith(".txt"):
+            with io.open(value, "r", encoding="utf-8") as f:
+                items += [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+        else:
+            items.append(value)
+    return items
+
+
+def run_batch(name, items, fn):
+    """
+    Call `fn` on every item in turn, in the current process, so that interpreter startup, module imports and the
+    Cytomine session are paid once for the whole batch. In a batch of several items, a failing item is logged and
+    does not stop the others. Return the list of failed items.
+    """
+    failures = []
+    for i, item in enumerate(items):
+        logging.info("[{} {}/{}] {}".format(name, i + 1, len(items), item))
+        start = time.time()
+        try:
+            fn(item)
+        except Exception:
+            if len(items) == 1:
+                raise
+            logging.exception("[{} {}/{}] {} failed.".format(name, i + 1, len(items), item))
+            failures.append(item)
+            continue
+        logging.info("[{} {}/{}] {} done in {:.1f}s.".format(name, i + 1, len(items), item, time.time() - start))
+
+    if len(items) > 1:
+        logging.info("Batch {}: {}/{} succeeded.".format(name, len(items) - len(failures), len(items)))
+        for item in failures:
+            logging.error("Batch {}: {} failed.".format(name, item))
+    return failures
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import math
+import threading
+
+from cytomine import Cytomine
+
+from cytomineprojectmigrator.resilience import PermanentFailure
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+def _get(resilience, uri, payload=None):
+    """GET a listing, or None if the server does not provide it."""
+    try:
+        return resilience.call(Cytomine.get_instance().get, uri, payload)
+    except PermanentFailure as e:
+        logging.warning("Bulk metadata discovery with {} is not available ({}).".format(uri, e))
+        return None
+
+
+def _records(response):
+    if isinstance(response, dict):
+        return response.get("collection", [])
+    return response
+
+
+class DomainListings:
+    """
+    Server-wide listings of the objects holding attached files or descriptions. The server cannot scope them to a
+    project, so that a listing is only fetched (page by page) when it costs fewer requests than probing the
+    objects one by one. A fetched listing is kept for the rest of the run, and can be shared by the exports of
+    several projects.
+    """
+    def __init__(self, resilience, page_size=1000):
+        self.resilience = resilience
+        self.page_size = page_size
+
+        self._lock = threading.Lock()
+        self._sizes = {}
+        self._holders = {}
+
+    def holders(self, uri, n_objects):
+        """Return the (domainClassName, domainIdent) pairs listed by `uri`, or None if probing is cheaper."""
+        with self._lock:
+            if uri in self._holders:
+                return self._holders[uri]
+
+            if uri not in self._sizes:
+                response = _get(self.resilience, uri, {"max": 1, "offset": 0})
+                if response is None or not isinstance(response, dict) or response.get("size") is None:
+                    # Not available, or not paginated: the answer is the whole listing (or nothing).
+                    self._holders[uri] = self._domains(response)
+                    return self._holders[uri]
+                self._sizes[uri] = int(response["size"])
+
+            n_pages = int(math.ceil(self._sizes[uri] / self.page_size))
+            if n_pages >= n_objects:
+                return None
+
+            records = []
+            for offset in range(0, self._sizes[uri], self.page_size):
+                response = _get(self.resilience, uri, {"max": self.page_size, "offset": offset})
+                if response is None:
+                    self._holders[uri] = None
+                    return None
+                records += _records(response)
+            logging.info("{} listed in {} requests ({} records).".format(uri, n_pages, len(records)))
+            self._holders[uri] = self._domains(records)
+            return self._holders[uri]
+
+    @staticmethod
+    def _domains(response):
+        if response is None:
+            return None
+        return set((r.get("domainClassName"), r.get("domainIdent")) for r in _records(response))
+
+
+class MetadataDiscovery:
+    """
+    Find out in bulk which objects carry properties, attached files or a description, so that details are only
+    fetched for those objects instead of probing every object. Attached files and descriptions are looked up in
+    server-wide listings when it is cheaper than probing (see DomainListings); property holders are discovered
+    per domain class from the property keys used in the project.
+
+    Whenever a bulk request is not available on the server or costs more than probing, the answer is unknown
+    (None) and the corresponding objects are probed one by one, as before.
+    """
+    def __init__(self, project, resilience, listings=None):
+        self.project = project
+        self.resilience = resilience
+        self.listings = listings if listings else DomainListings(resilience)
+
+    def _get(self, uri, payload=None):
+        response = _get(self.resilience, uri, payload)
+        return None if response is None else _records(response)
+
+    def attached_file_holders(self, n_objects):
+        return self.listings.holders("attachedfile.json", n_objects)
+
+    def description_holders(self, n_objects):
+        return self.listings.holders("description.json", n_objects)
+
+    def _property_keys(self, uri):
+        keys = self._get(uri, {"idProject": self.project.id})
+        if keys is None:
+            return None
+        return [k.get("key") if isinstance(k, dict) else k for k in keys]
+
+    def property_holders(self, objects, class_name):
+        """Return the ids of the objects (all of `class_name`) that carry properties, or None if unknown."""
+        if class_name.endswith("Annotation"):
+            keys = self._property_keys("annotation/property/key.json")
+            if keys is None or len(keys) == 0:
+                return None if keys is None else set()
+
+            # Positions of annotations having a given key are listed per user and image.
+            pairs = set((o.user, o.image) for o in objects)
+            if len(keys) * len(pairs) >= len(objects):
+                return None
+
+            holders = set()
+            for key in keys:
+                for user, image in pairs:
+                    positions = self._get("user/{}/imageinstance/{}/annotationposition.json".format(user, image),
+                                          {"key": key})
+                    if positions is None:
+                        return None
+                    holders.update(p.get("idAnnotation", p.get("id")) for p in positions)
+            return holders
+
+        if class_name.endswith("ImageInstance"):
+            keys = self._property_keys("imageinstance/property/key.json")
+            return set() if keys is not None and len(keys) == 0 else None
+
+        return None
+
+    def plan(self, objects):
+        """
+        Return a list of (object, with_properties, with_attached_files, with_description) tuples, one per object
+        that may carry metadata. Objects known to carry none are left out.
+        """
+        by_class = {}
+        for obj in objects:
+            by_class.setdefault(getattr(obj, "class_", None), []).append(obj)
+
+        attached_files = self.attached_file_holders(len(objects))
+        descriptions = self.description_holders(len(objects))
+
+        plan = []
+        for class_name, objs in by_class.items():
+            properties = self.property_holders(objs, class_name) if class_name else None
+            for obj in objs:
+                domain = (class_name, obj.id)
+                with_properties = properties is None or obj.id in properties
+                with_attached_files = attached_files is None or class_name is None or domain in attached_files
+                with_description = descriptions is None or class_name is None or domain in descriptions
+                if with_properties or with_attached_files or with_description:
+                    plan.append((obj, with_properties, with_attached_files, with_description))
+
+        logging.info("Metadata discovery: {}/{} objects may carry metadata.".format(len(plan), len(objects)))
+        return plan
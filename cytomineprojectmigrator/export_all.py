@@ -25,7 +25,12 @@ from argparse import ArgumentParser
 from cytomine import Cytomine
 from cytomine.models import ProjectCollection
 
+from cytomineprojectmigrator.discovery import DomainListings
 from cytomineprojectmigrator.exporter import Exporter
+from cytomineprojectmigrator.filters import ExportFilter
+from cytomineprojectmigrator.governor import Governor, parse_stage_limits
+from cytomineprojectmigrator.resilience import Resilience
+from cytomineprojectmigrator.transfer import ImageTransfer
 
 __author__ = "Rubens Ulysse <urubens@uliege.be>"
 
@@ -42,13 +47,67 @@ if __name__ == '__main__':
     parser.add_argument('--without_image_download', default=False, help="Do not download images but export image metadata.")
     parser.add_argument('--without_user_annotations', default=False, help="Do not export user annotations.")
     parser.add_argument('--without_metadata', default=False, help="Do not export any metadata.")
-    parser.add_argument('--without_annotation_metadata', default=True, help="Do not export annotation metadata "
-                                                                            "(speed up processing).")
+    parser.add_argument('--without_annotation_metadata', default=False, help="Do not export annotation metadata.")
+    parser.add_argument('--download_connections', default=None, help="Maximum number of simultaneous image "
+                                                                     "download requests for the whole export "
+                                                                     "(default: half of --max_connections).")
+    parser.add_argument('--download_chunk_size', default=64, help="Size (in MB) of the HTTP Range chunks used to "
+                                                                 "download large images in parallel.")
+    parser.add_argument('--max_retries', default=5, help="Number of retries of a failed request before giving up.")
+    parser.add_argument('--retry_delay', default=1, help="Base delay (in seconds) of the exponential backoff "
+                                                         "between retries.")
+    parser.add_argument('--max_connections', default=None, help="Maximum number of requests in flight for the whole "
+                                                               "run (default: size of the HTTP connection pool).")
+    parser.add_argument('--max_request_rate', default=None, help="Maximum number of requests started per second.")
+    parser.add_argument('--stage_limits', default=None, help="Maximum number of requests in flight per stage, as "
+                                                             "stage=limit pairs (e.g. metadata=6,download=4).")
+    parser.add_argument('--images', default=None, help="Only export images matching these comma-separated "
+                                                       "image instance ids and/or filename patterns (e.g. *.svs).")
+    parser.add_argument('--terms', default=None, help="Only export user annotations having one of these term ids "
+                                                      "(comma-separated).")
+    parser.add_argument('--annotation_users', default=None, help="Only export user annotations created by these "
+                                                                 "user ids (comma-separated).")
+    parser.add_argument('--created_after', default=None, help="Only export user annotations created after this date "
+                                                              "(ISO 8601 or epoch ms).")
+    parser.add_argument('--created_before', default=None, help="Only export user annotations created before this "
+                                                               "date (ISO 8601 or epoch ms).")
+    parser.add_argument('--updated_after', default=None, help="Only export user annotations updated after this date "
+                                                              "(ISO 8601 or epoch ms).")
+    parser.add_argument('--updated_before', default=None, help="Only export user annotations updated before this "
+                                                               "date (ISO 8601 or epoch ms).")
+    parser.add_argument('--metadata_shard_size', default=100000, help="Maximum number of metadata records per "
+                                                                       "JSON-lines shard of the archive.")
+    parser.add_argument('--profile', default=False, help="Profile CPU time and memory allocations of every stage of "
+                                                         "the exports.")
     params, other = parser.parse_known_args(sys.argv[1:])
 
     with Cytomine(params.host, params.public_key, params.private_key) as _:
         Cytomine.get_instance().open_admin_session()
-        options = {k:v for (k,v) in vars(params).items() if k.startswith('without') or k == 'anonymize'}
+        options = {k:v for (k,v) in vars(params).items() if k.startswith('without')
+                   or k in ('anonymize', 'max_retries', 'retry_delay', 'images', 'terms', 'annotation_users',
+                            'created_after', 'created_before', 'updated_after', 'updated_before',
+                            'metadata_shard_size', 'profile')}
+
+        # A single governor and transfer engine are shared by all projects so that limits hold for the whole run.
+        stage_limits = parse_stage_limits(params.stage_limits)
+        if params.download_connections:
+            stage_limits.setdefault("download", int(params.download_connections))
+        governor = Governor(max_in_flight=params.max_connections, max_rate=params.max_request_rate,
+                            stage_limits=stage_limits)
+        options['governor'] = governor
+        options['image_transfer'] = ImageTransfer(chunk_size=int(params.download_chunk_size) * 1024 * 1024,
+                                                  resilience=Resilience(max_retries=int(params.max_retries),
+                                                                        base_delay=float(params.retry_delay),
+                                                                        governor=governor),
+                                                  governor=governor)
+        options['metadata_listings'] = DomainListings(options['image_transfer'].resilience)
+        # The filter is shared by all the exported projects, so that requested images are fetched once.
+        options['export_filter'] = ExportFilter(images=params.images, terms=params.terms,
+                                                annotation_users=params.annotation_users,
+                                                created_after=params.created_after,
+                                                created_before=params.created_before,
+                                                updated_after=params.updated_after,
+                                                updated_before=params.updated_before)
 
         for project in ProjectCollection().fetch():
             exporter = Exporter(params.working_path, project.id, **options)
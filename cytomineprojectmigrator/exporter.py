@@ -19,20 +19,30 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
 import logging
 import os
 import shutil
 import sys
+import threading
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from cytomine import Cytomine
 from cytomine.models import Project, Model, Collection, Ontology, TermCollection, ImageInstanceCollection, \
-    AnnotationCollection, UserCollection, User, PropertyCollection, \
+    ImageInstance, AnnotationCollection, UserCollection, User, PropertyCollection, \
     AttachedFileCollection, Description
 from cytomine.models.image import SliceInstanceCollection
-from joblib import Parallel, delayed
 
+from cytomineprojectmigrator.archive import ArchiveWriter
+from cytomineprojectmigrator.batch import expand_items, run_batch
+from cytomineprojectmigrator.discovery import DomainListings, MetadataDiscovery
+from cytomineprojectmigrator.filters import ExportFilter, parse_list
+from cytomineprojectmigrator.governor import Governor, parse_stage_limits
+from cytomineprojectmigrator.profiling import StageProfiler, profiled
+from cytomineprojectmigrator.resilience import PermanentFailure, Resilience
+from cytomineprojectmigrator.transfer import ImageTransfer, TransferCancelled
 
 __author__ = "Rubens Ulysse <urubens@uliege.be>"
 
@@ -46,10 +56,37 @@ def find_or_append_by_id(obj, l):
         return obj
 
 
+class BackgroundTask(threading.Thread):
+    """Run a function in a background thread. Exceptions are re-raised in the caller thread by `join`."""
+    def __init__(self, fn, *args, **kwargs):
+        super(BackgroundTask, self).__init__(name=getattr(fn, "__name__", None))
+        self.daemon = True
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+        self._error = None
+
+    def run(self):
+        try:
+            self._fn(*self._args, **self._kwargs)
+        except BaseException as e:
+            self._error = e
+
+    def join(self, timeout=None):
+        super(BackgroundTask, self).join(timeout)
+        if self._error is not None:
+            raise self._error
+
+
 class Exporter:
     def __init__(self, working_path, id_project, without_image_download=False, without_image_groups=False,
                  without_user_annotations=False, without_metadata=False, without_annotation_metadata=False,
-                 anonymize=False):
+                 anonymize=False, image_transfer=None, download_connections=None, download_chunk_size=64,
+                 resilience=None, max_retries=5, retry_delay=1, governor=None, max_connections=None,
+                 max_request_rate=None, stage_limits=None, images=None, terms=None, annotation_users=None,
+                 created_after=None, created_before=None, updated_after=None, updated_before=None,
+                 metadata_shard_size=100000, profile=False, profile_path=None, metadata_listings=None,
+                 export_filter=None):
         self.project = Project().fetch(id_project)
         if not self.project:
             raise ValueError("Project not found")
@@ -58,6 +95,9 @@ class Exporter:
         self.project_directory = "{}-{}-{}-{}".format(*[str(item).replace(" ", "-") for item in items])
         self.working_path = working_path
         self.project_path = os.path.join(working_path, self.project_directory)
+        # Partial image files are kept out of the (dated) project directory, so that the next export of the same
+        # project resumes their download.
+        self.partial_download_path = os.path.join(working_path, "{}-{}-partial-downloads".format(*items[:2]))
         self.attached_file_path = None
 
         self.with_image_download = not without_image_download
@@ -66,10 +106,56 @@ class Exporter:
         self.with_annotation_metadata = not without_annotation_metadata
         self.with_metadata = not without_metadata
         self.anonymize = anonymize
+        if export_filter is None:
+            export_filter = ExportFilter(images=images, terms=terms, annotation_users=annotation_users,
+                                         created_after=created_after, created_before=created_before,
+                                         updated_after=updated_after, updated_before=updated_before)
+        self.filter = export_filter
+
+        if governor is None:
+            stage_limits = parse_stage_limits(stage_limits)
+            if download_connections:
+                stage_limits.setdefault("download", int(download_connections))
+            governor = Governor(max_in_flight=max_connections, max_rate=max_request_rate, stage_limits=stage_limits)
+        self.governor = governor
+
+        if resilience is None:
+            dead_letter_path = os.path.join(working_path, "{}-dead-letters.jsonl".format(self.project_directory))
+            resilience = Resilience(max_retries=int(max_retries), base_delay=float(retry_delay),
+                                    dead_letter_path=dead_letter_path, governor=self.governor)
+        self.resilience = resilience
+
+        if image_transfer is None:
+            image_transfer = ImageTransfer(chunk_size=int(download_chunk_size) * 1024 * 1024,
+                                           resilience=self.resilience, governor=self.governor)
+        self.image_transfer = image_transfer
+
+        self.metadata_discovery = MetadataDiscovery(self.project, self.resilience, metadata_listings)
+        self.archive = ArchiveWriter(self.project_path, shard_size=int(metadata_shard_size))
+
+        if profile and profile_path is None:
+            profile_path = "{}-profile".format(self.project_path)
+        self.profiler = StageProfiler(profile_path)
 
         self.users = UserCollection()
+        self.image_download = None
+        self.cancel_downloads = threading.Event()
 
     def run(self):
+        try:
+            self._run()
+        except BaseException:
+            # Do not leave the downloads of a failed export running (and holding download slots) in background.
+            if self.image_download:
+                self.cancel_downloads.set()
+                try:
+                    self.image_download.join()
+                except Exception as e:
+                    logging.error("Image downloads failed too: {}".format(e))
+                self.image_download = None
+            raise
+
+    def _run(self):
         logging.info("Export will be done in directory {}".format(self.project_path))
         os.makedirs(self.project_path)
 
@@ -78,16 +164,16 @@ class Exporter:
             os.makedirs(self.attached_file_path)
 
         # --------------------------------------------------------------------------------------------------------------
-        logging.info("1/ Export project {}".format(self.project.id))
+        self.profiler.stage("1/ Export project {}".format(self.project.id))
         self.save_object(self.project)
 
         logging.info("1.1/ Export project managers")
-        admins = UserCollection(admin=True).fetch_with_filter("project", self.project.id)
+        admins = self.resilience.call(UserCollection(admin=True).fetch_with_filter, "project", self.project.id)
         for admin in admins:
             self.save_user(admin, "project_manager")
 
         logging.info("1.2/ Export project contributors")
-        users = UserCollection().fetch_with_filter("project", self.project.id)
+        users = self.resilience.call(UserCollection().fetch_with_filter, "project", self.project.id)
         for user in users:
             self.save_user(user, "project_contributor")
 
@@ -96,12 +182,12 @@ class Exporter:
             self.export_metadata([self.project])
 
         # --------------------------------------------------------------------------------------------------------------
-        logging.info("2/ Export ontology {}".format(self.project.ontology))
-        ontology = Ontology().fetch(self.project.ontology)
+        self.profiler.stage("2/ Export ontology {}".format(self.project.ontology))
+        ontology = self.resilience.call(Ontology().fetch, self.project.ontology)
         self.save_object(ontology)
 
         logging.info("2.1/ Export ontology creator")
-        user = User().fetch(ontology.user)
+        user = self.resilience.call(User().fetch, ontology.user)
         self.save_user(user, "ontology_creator")
 
         if self.with_metadata:
@@ -109,8 +195,8 @@ class Exporter:
             self.export_metadata([ontology])
 
         # --------------------------------------------------------------------------------------------------------------
-        logging.info("3/ Export terms")
-        terms = TermCollection().fetch_with_filter("project", self.project.id)
+        self.profiler.stage("3/ Export terms")
+        terms = self.resilience.call(TermCollection().fetch_with_filter, "project", self.project.id)
         self.save_object(terms)
 
         if self.with_metadata:
@@ -118,37 +204,35 @@ class Exporter:
             self.export_metadata(terms)
 
         # --------------------------------------------------------------------------------------------------------------
-        logging.info("4/ Export images")
-        images = ImageInstanceCollection().fetch_with_filter("project", self.project.id)
+        self.profiler.stage("4/ Export images")
+        images = self.fetch_images()
         self.save_object(images)
 
         if self.with_image_download:
             image_path = os.path.join(self.project_path, "images")
             os.makedirs(image_path)
 
-            def _download_image(image, path):
-                logging.info("Download file for image {}".format(image))
-                image.download(os.path.join(path, image.originalFilename), override=False, parent=True)
-
-            # Temporary use threading as backend, as we need to connect to Cytomine in every other processes.
-            Parallel(n_jobs=-1, backend="threading")(delayed(_download_image)(image, image_path) for image in images)
+            # Image files are not needed by the next steps: download them in background while the export goes on.
+            logging.info("Image downloads started in background")
+            self.image_download = BackgroundTask(self.download_images, images, image_path)
+            self.image_download.start()
 
         logging.info("4.1/ Export image slices")
         slices = SliceInstanceCollection()
         for image in images:
-            slices += SliceInstanceCollection().fetch_with_filter("imageinstance", image.id)
+            slices += self.resilience.call(SliceInstanceCollection().fetch_with_filter, "imageinstance", image.id)
         self.save_object(slices)
 
         logging.info("4.2/ Export image creator users")
         image_users = set([image.user for image in images])
         for image_user in image_users:
-            user = User().fetch(image_user)
+            user = self.resilience.call(User().fetch, image_user)
             self.save_user(user, "image_creator")
 
         logging.info("4.3/ Export image reviewer users")
         image_users = set([image.reviewUser for image in images if image.reviewUser])
         for image_user in image_users:
-            user = User().fetch(image_user)
+            user = self.resilience.call(User().fetch, image_user)
             self.save_user(user, "image_reviewer")
 
         if self.with_metadata:
@@ -156,20 +240,20 @@ class Exporter:
             self.export_metadata(images)
 
         # --------------------------------------------------------------------------------------------------------------
-        logging.info("4/ Export user annotations")
-        user_annotations = AnnotationCollection(showWKT=True, showTerm=True, project=self.project.id).fetch()
+        self.profiler.stage("4/ Export user annotations")
+        user_annotations = self.fetch_user_annotations(images)
         self.save_object(user_annotations, filename="user-annotation-collection")
 
         logging.info("4.1/ Export user annotation creator users")
         annotation_users = set([annotation.user for annotation in user_annotations])
         for annotation_user in annotation_users:
-            user = User().fetch(annotation_user)
+            user = self.resilience.call(User().fetch, annotation_user)
             self.save_user(user, "userannotation_creator")
 
         logging.info("4.2/ Export user annotation term creator users")
         annotation_users = set([annotation.userTerm for annotation in user_annotations if hasattr(annotation, "userTerm") and annotation.userTerm])
         for annotation_user in annotation_users:
-            user = User().fetch(annotation_user)
+            user = self.resilience.call(User().fetch, annotation_user)
             self.save_user(user, "userannotationterm_creator")
 
         if self.with_annotation_metadata:
@@ -177,7 +261,7 @@ class Exporter:
             self.export_metadata(user_annotations)
 
         # --------------------------------------------------------------------------------------------------------------
-        logging.info("5/ Export users")
+        self.profiler.stage("5/ Export users")
         if self.anonymize:
             for i, user in enumerate(self.users):
                         user.username = "anonymized_user{}".format(i + 1)
@@ -193,32 +277,137 @@ class Exporter:
         #     self.export_metadata(self.users)
 
         # --------------------------------------------------------------------------------------------------------------
+        if self.image_download:
+            self.profiler.stage("6/ Wait for image downloads to finish")
+            self.image_download.join()
+            self.image_download = None
+
+        self.archive.close()
+        self.resilience.report()
+        self.governor.report()
+        self.profiler.close()
         logging.info("Finished.")
 
+    def fetch_images(self):
+        if self.filter.image_ids and not self.filter.image_patterns:
+            # Only the requested images are fetched.
+            def _fetch_image(id_image):
+                try:
+                    image = self.resilience.call_optional(ImageInstance().fetch, id_image)
+                except PermanentFailure as e:
+                    logging.warning("Image {} cannot be fetched, skipped ({}).".format(id_image, e))
+                    return None
+                if image is None:
+                    logging.warning("Image {} does not exist, skipped.".format(id_image))
+                return image
+
+            images = ImageInstanceCollection()
+            for image in self.filter.requested_images(_fetch_image):
+                if image.project == self.project.id:
+                    images.append(image)
+            return images
+
+        images = self.resilience.call(ImageInstanceCollection().fetch_with_filter, "project", self.project.id)
+        if not self.filter.filters_images:
+            return images
+
+        kept = ImageInstanceCollection()
+        for image in images:
+            if self.filter.keep_image(image):
+                kept.append(image)
+        logging.info("{}/{} images selected for export.".format(len(kept), len(images)))
+        return kept
+
+    def fetch_user_annotations(self, images):
+        if not self.filter.filters_annotations:
+            user_annotations = AnnotationCollection(showWKT=True, showTerm=True, project=self.project.id)
+            return self.resilience.call(user_annotations.fetch)
+
+        image_ids = set(image.id for image in images)
+        if self.filter.filters_images and len(image_ids) == 0:
+            return AnnotationCollection()
+
+        parameters = self.filter.annotation_parameters(image_ids)
+        user_annotations = AnnotationCollection(showWKT=True, showTerm=True, project=self.project.id, **parameters)
+        user_annotations = self.resilience.call(user_annotations.fetch)
+
+        # Filters the server may not support (e.g. updated window) are enforced here.
+        kept = AnnotationCollection()
+        for annotation in user_annotations:
+            if self.filter.keep_annotation(annotation, image_ids):
+                kept.append(annotation)
+        logging.info("{}/{} user annotations selected for export.".format(len(kept), len(user_annotations)))
+        return kept
+
+    def download_images(self, images, path):
+        def _download(image):
+            partial = os.path.join(self.partial_download_path, "{}-{}.part".format(image.id, image.originalFilename))
+            try:
+                self.image_transfer.download_image(image, os.path.join(path, image.originalFilename), override=False,
+                                                   parent=True, partial=partial, cancel=self.cancel_downloads)
+            except TransferCancelled:
+                logging.info("Download of image {} cancelled, partial file kept.".format(image.id))
+
+        @profiled
+        def _download_image(image):
+            if self.cancel_downloads.is_set():
+                return
+            logging.info("Download file for image {}".format(image))
+            item = {"imageinstance": image.id, "originalFilename": image.originalFilename}
+            # The transfer engine retries each of its requests: a failed image is not downloaded again as a whole.
+            self.resilience.dead_letter_on_failure("image_download", item, _download, image)
+
+        # Threads, as we would need to connect to Cytomine in every other process.
+        # The transfer engine holds a governor "download" slot for every request, images themselves do not.
+        with ThreadPoolExecutor(max_workers=self.image_transfer.max_connections) as executor:
+            list(executor.map(_download_image, images))
+        if os.path.isdir(self.partial_download_path) and not os.listdir(self.partial_download_path):
+            os.rmdir(self.partial_download_path)
+        logging.info("All image files have been downloaded.")
+
     def export_metadata(self, objects):
-        def _export_metadata(save_object_fn, obj, attached_file_path):
-            properties = PropertyCollection(obj).fetch()
-            if len(properties) > 0:
-                save_object_fn(properties, "properties-object-{}-collection".format(obj.id))
-
-            attached_files = AttachedFileCollection(obj).fetch()
-            if len(attached_files) > 0:
-                save_object_fn(attached_files, "attached-files-object-{}-collection".format(obj.id))
-                for attached_file in attached_files:
-                    attached_file.download(os.path.join(attached_file_path, "{filename}"), True)
-
-            description = Description(obj).fetch()
+        def _export_metadata(archive, obj, attached_file_path, with_properties=True, with_attached_files=True,
+                             with_description=True):
+            # Every request is retried on its own. Records are only appended to the archive once everything has
+            # been fetched, so that a failed object is not partially written.
+            records = []
+            if with_properties:
+                properties = self.resilience.call(PropertyCollection(obj).fetch)
+                if len(properties) > 0:
+                    records.append(("properties", json.loads(properties.to_json())))
+
+            if with_attached_files:
+                attached_files = self.resilience.call(AttachedFileCollection(obj).fetch)
+                if len(attached_files) > 0:
+                    records.append(("attached-files", json.loads(attached_files.to_json())))
+                    for attached_file in attached_files:
+                        self.resilience.call(attached_file.download, os.path.join(attached_file_path, "{filename}"),
+                                             True)
+
+            description = self.resilience.call_optional(Description(obj).fetch) if with_description else None
             if description:
-                save_object_fn(description, "description-object-{}".format(obj.id))
+                records.append(("description", [json.loads(description.to_json())]))
 
-                attached_files = AttachedFileCollection(description).fetch()
+                attached_files = self.resilience.call(AttachedFileCollection(description).fetch)
                 if len(attached_files) > 0:
-                    save_object_fn(attached_files, "attached-files-object-{}-collection".format(obj.id))
+                    records.append(("attached-files", json.loads(attached_files.to_json())))
                     for attached_file in attached_files:
-                        attached_file.download(os.path.join(attached_file_path, "{filename}"), True)
+                        self.resilience.call(attached_file.download, os.path.join(attached_file_path, "{filename}"),
+                                             True)
+
+            for record_type, items in records:
+                archive.append(record_type, items)
 
-        Parallel(n_jobs=-1, backend="threading")(delayed(_export_metadata)(self.save_object, obj, self.attached_file_path)
-                                                 for obj in objects)
+        def _export_metadata_or_dead_letter(entry):
+            obj, with_properties, with_attached_files, with_description = entry
+            item = {obj.callback_identifier: obj.id}
+            self.resilience.dead_letter_on_failure("metadata", item, _export_metadata, self.archive, obj,
+                                                   self.attached_file_path, with_properties, with_attached_files,
+                                                   with_description)
+
+        # Only fetch details for the objects that actually carry metadata.
+        plan = self.metadata_discovery.plan(objects)
+        self.governor.map("metadata", _export_metadata_or_dead_letter, plan)
 
     def save_user(self, user, role=None):
         u = find_or_append_by_id(user, self.users)
@@ -231,18 +420,28 @@ class Exporter:
         if not obj:
             return
 
+        count = 1
         if filename:
+            record_type = filename
             filename = "{}.json".format(filename)
         elif isinstance(obj, Model):
+            record_type = obj.callback_identifier
             filename = "{}-{}.json".format(obj.callback_identifier, obj.id)
         elif isinstance(obj, Collection):
-            filename = "{}-collection.json".format(obj.callback_identifier)
+            record_type = "{}-collection".format(obj.callback_identifier)
+            filename = "{}.json".format(record_type)
+
+        if isinstance(obj, Collection):
+            count = len(obj)
 
-        with open(os.path.join(self.project_path, filename), 'w') as outfile:
-            outfile.write(obj.to_json())
-            logging.info("Object {} has been saved locally.".format(obj))
+        self.archive.save(record_type, filename, obj.to_json(), count)
+        logging.info("Object {} has been saved locally.".format(obj))
 
     def make_archive(self):
+        if self.image_download:
+            self.image_download.join()
+            self.image_download = None
+
         logging.info("Making archive...")
         shutil.make_archive(self.project_path, "gztar", self.working_path, self.project_directory)
         logging.info("Finished.")
@@ -255,7 +454,9 @@ if __name__ == '__main__':
                                              "The underlying user has to be a manager of the exported project.")
     parser.add_argument('--private_key', help="The Cytomine private key used to export the project. "
                                               "The underlying user has to be a manager of the exported project.")
-    parser.add_argument('--id_project', help="The Cytomine identifier of the project to export.")
+    parser.add_argument('--id_project', nargs='+', help="The Cytomine identifier of the project to export. Several "
+                                                        "identifiers (or .txt files listing them) are exported one "
+                                                        "after the other in the same process.")
     parser.add_argument('--make_archive', default=True, help="Make an archive for the exported project.")
     parser.add_argument('--working_path', default="", help="The base path where the generated archive will be stored.")
     parser.add_argument('--anonymize', default=False, help="Anonymize users in the project.")
@@ -263,15 +464,71 @@ if __name__ == '__main__':
     parser.add_argument('--without_image_groups', default=False, help="Do not export image groups.")
     parser.add_argument('--without_user_annotations', default=False, help="Do not export user annotations.")
     parser.add_argument('--without_metadata', default=False, help="Do not export any metadata.")
-    parser.add_argument('--without_annotation_metadata', default=True, help="Do not export annotation metadata "
-                                                                            "(speed up processing).")
+    parser.add_argument('--without_annotation_metadata', default=False, help="Do not export annotation metadata.")
+    parser.add_argument('--download_connections', default=None, help="Maximum number of simultaneous image "
+                                                                     "download requests for the whole export "
+                                                                     "(default: half of --max_connections).")
+    parser.add_argument('--download_chunk_size', default=64, help="Size (in MB) of the HTTP Range chunks used to "
+                                                                 "download large images in parallel.")
+    parser.add_argument('--max_retries', default=5, help="Number of retries of a failed request before giving up.")
+    parser.add_argument('--retry_delay', default=1, help="Base delay (in seconds) of the exponential backoff "
+                                                         "between retries.")
+    parser.add_argument('--max_connections', default=None, help="Maximum number of requests in flight for the whole "
+                                                               "run (default: size of the HTTP connection pool).")
+    parser.add_argument('--max_request_rate', default=None, help="Maximum number of requests started per second.")
+    parser.add_argument('--stage_limits', default=None, help="Maximum number of requests in flight per stage, as "
+                                                             "stage=limit pairs (e.g. metadata=6,download=4).")
+    parser.add_argument('--images', default=None, help="Only export these images, given as comma-separated "
+                                                       "image instance ids and/or filename patterns (e.g. 12,*.svs).")
+    parser.add_argument('--terms', default=None, help="Only export user annotations having one of these term ids "
+                                                      "(comma-separated).")
+    parser.add_argument('--annotation_users', default=None, help="Only export user annotations created by these "
+                                                                 "user ids (comma-separated).")
+    parser.add_argument('--created_after', default=None, help="Only export user annotations created after this date "
+                                                              "(ISO 8601 or epoch ms).")
+    parser.add_argument('--created_before', default=None, help="Only export user annotations created before this "
+                                                               "date (ISO 8601 or epoch ms).")
+    parser.add_argument('--updated_after', default=None, help="Only export user annotations updated after this date "
+                                                              "(ISO 8601 or epoch ms).")
+    parser.add_argument('--updated_before', default=None, help="Only export user annotations updated before this "
+                                                               "date (ISO 8601 or epoch ms).")
+    parser.add_argument('--metadata_shard_size', default=100000, help="Maximum number of metadata records per "
+                                                                       "JSON-lines shard of the archive.")
+    parser.add_argument('--profile', default=False, help="Profile CPU time and memory allocations of every stage of "
+                                                         "the export.")
+    parser.add_argument('--profile_path', default=None, help="Where to write the stage profiles and their summary "
+                                                             "(default: next to the project directory).")
     params, other = parser.parse_known_args(sys.argv[1:])
 
     with Cytomine(params.host, params.public_key, params.private_key) as _:
         Cytomine.get_instance().open_admin_session()
-        options = {k:v for (k,v) in vars(params).items() if k.startswith('without') or k == 'anonymize'}
-        exporter = Exporter(params.working_path, params.id_project, **options)
-        exporter.run()
-        if params.make_archive:
-            exporter.make_archive()
+        options = {k:v for (k,v) in vars(params).items() if k.startswith('without') or k.startswith('download')
+                   or k in ('anonymize', 'max_retries', 'retry_delay', 'max_connections', 'max_request_rate',
+                            'stage_limits', 'images', 'terms', 'annotation_users', 'created_after', 'created_before',
+                            'updated_after', 'updated_before', 'metadata_shard_size', 'profile', 'profile_path')}
+
+        # The filter is shared by all the exported projects, so that requested images are fetched once.
+        options['export_filter'] = ExportFilter(images=params.images, terms=params.terms,
+                                                annotation_users=params.annotation_users,
+                                                created_after=params.created_after,
+                                                created_before=params.created_before,
+                                                updated_after=params.updated_after,
+                                                updated_before=params.updated_before)
+        # Server-wide metadata listings are fetched at most once for all the exported projects.
+        options['metadata_listings'] = DomainListings(Resilience(max_retries=int(params.max_retries),
+                                                                 base_delay=float(params.retry_delay)))
+
+        def _export(id_project):
+            exporter = Exporter(params.working_path, id_project, **options)
+            try:
+                exporter.run()
+            finally:
+                exporter.profiler.close()
+            if params.make_archive:
+                exporter.make_archive()
+
+        failures = run_batch("export", [i for item in expand_items(params.id_project) for i in parse_list(item)],
+                             _export)
         Cytomine.get_instance().close_admin_session()
+
+    sys.exit(1 if len(failures) > 0 else 0)
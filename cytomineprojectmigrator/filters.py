@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import calendar
+import fnmatch
+from datetime import datetime
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+def parse_list(value):
+    if value is None or value == "":
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [v.strip() for v in str(value).split(",") if v.strip()]
+
+
+def parse_timestamp(value):
+    """Parse a date given as epoch milliseconds or ISO 8601 (UTC) into Cytomine epoch milliseconds."""
+    if value is None or value == "":
+        return None
+    value = str(value)
+    if value.isdigit():
+        return int(value)
+    for date_format in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return calendar.timegm(datetime.strptime(value, date_format).timetuple()) * 1000
+        except ValueError:
+            continue
+    raise ValueError("Invalid date: {}".format(value))
+
+
+class ExportFilter:
+    """
+    Restrict an export to a subset of a project. Images are selected by id or filename pattern (fnmatch); user
+    annotations by term, creator and a created/updated time window. Filters are turned into server-side query
+    parameters where the API supports it, and also checked locally on what is returned.
+    """
+    def __init__(self, images=None, terms=None, annotation_users=None, created_after=None, created_before=None,
+                 updated_after=None, updated_before=None):
+        images = parse_list(images)
+        self.image_ids = set(int(i) for i in images if str(i).isdigit())
+        self.image_patterns = [i for i in images if not str(i).isdigit()]
+        self.term_ids = set(int(t) for t in parse_list(terms))
+        self.annotation_users = set(int(u) for u in parse_list(annotation_users))
+        self.created_after = parse_timestamp(created_after)
+        self.created_before = parse_timestamp(created_before)
+        self.updated_after = parse_timestamp(updated_after)
+        self.updated_before = parse_timestamp(updated_before)
+        self._requested_images = None
+
+    @property
+    def filters_images(self):
+        return len(self.image_ids) > 0 or len(self.image_patterns) > 0
+
+    @property
+    def filters_annotations(self):
+        return self.filters_images or len(self.term_ids) > 0 or len(self.annotation_users) > 0 \
+               or any(d is not None for d in (self.created_after, self.created_before,
+                                              self.updated_after, self.updated_before))
+
+    def requested_images(self, fetch):
+        """
+        Images requested by id, fetched with `fetch(id)` (returning None for an image that cannot be fetched).
+        They are fetched once, even if the filter is shared by the exports of several projects.
+        """
+        if self._requested_images is None:
+            self._requested_images = []
+            for id_image in sorted(self.image_ids):
+                image = fetch(id_image)
+                if image is not None:
+                    self._requested_images.append(image)
+        return self._requested_images
+
+    def keep_image(self, image):
+        if not self.filters_images:
+            return True
+        if image.id in self.image_ids:
+            return True
+        filename = getattr(image, "originalFilename", None) or ""
+        return any(fnmatch.fnmatch(filename, pattern) for pattern in self.image_patterns)
+
+    def annotation_parameters(self, image_ids=None):
+        """Query parameters of AnnotationCollection restricting the listing on the server."""
+        parameters = {}
+        if self.filters_images and image_ids is not None:
+            parameters["images"] = ",".join(str(i) for i in image_ids)
+        if len(self.term_ids) > 0:
+            parameters["terms"] = ",".join(str(t) for t in sorted(self.term_ids))
+        if len(self.annotation_users) > 0:
+            parameters["users"] = ",".join(str(u) for u in sorted(self.annotation_users))
+        if self.created_after is not None:
+            parameters["afterThan"] = self.created_after
+        if self.created_before is not None:
+            parameters["beforeThan"] = self.created_before
+        return parameters
+
+    def keep_annotation(self, annotation, image_ids=None):
+        if self.filters_images and image_ids is not None and annotation.image not in image_ids:
+            return False
+        if len(self.term_ids) > 0 and not self.term_ids.intersection(getattr(annotation, "term", None) or []):
+            return False
+        if len(self.annotation_users) > 0 and annotation.user not in self.annotation_users:
+            return False
+
+        def _in_window(value, after, before):
+            if after is None and before is None:
+                return True
+            if value is None:
+                return False
+            value = int(value)
+            return (after is None or value >= after) and (before is None or value <= before)
+
+        return _in_window(getattr(annotation, "created", None), self.created_after, self.created_before) \
+            and _in_window(getattr(annotation, "updated", None), self.updated_after, self.updated_before)
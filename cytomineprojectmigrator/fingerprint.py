@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import os
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+def file_digest(path, algorithm="sha256", block_size=1 << 20):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FingerprintIndex:
+    """
+    Content fingerprints of the image files of an archive. Files are first grouped by size, and only files sharing
+    their size with another one are hashed (streamed, so memory stays flat): a file with a unique size cannot have
+    a duplicate in the archive.
+    """
+    def __init__(self, working_path, directories=("images", "imagegroups")):
+        self.working_path = working_path
+        self.directories = directories
+        self._keys = {}
+        self._sizes = {}
+        self._built = False
+
+    def build(self):
+        by_size = {}
+        for directory in self.directories:
+            path = os.path.join(self.working_path, directory)
+            if not os.path.isdir(path):
+                continue
+            for filename in os.listdir(path):
+                file_path = os.path.abspath(os.path.join(path, filename))
+                if os.path.isfile(file_path):
+                    size = os.path.getsize(file_path)
+                    self._sizes[file_path] = size
+                    by_size.setdefault(size, []).append(file_path)
+
+        for size, paths in by_size.items():
+            if len(paths) == 1:
+                self._keys[paths[0]] = "size-{}".format(size)
+            else:
+                for file_path in paths:
+                    self._keys[file_path] = "{}-{}".format(size, file_digest(file_path))
+
+        self._built = True
+        n_distinct = len(set(self._keys.values()))
+        logging.info("Fingerprint index: {} files, {} distinct.".format(len(self._keys), n_distinct))
+        return self
+
+    def key(self, path):
+        if not self._built:
+            self.build()
+        return self._keys.get(os.path.abspath(path))
+
+    def size(self, path):
+        if not self._built:
+            self.build()
+        return self._sizes.get(os.path.abspath(path), 0)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from cytomine import Cytomine
+
+from cytomineprojectmigrator.profiling import profiled
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+DEFAULT_POOL_SIZE = 10
+
+# File transfers run in background of the other requests: by default, they get this share of the in-flight
+# requests and all the other stages the rest, so that neither starves the other.
+TRANSFER_STAGES = ("download", "upload")
+TRANSFER_SHARE = 0.5
+
+
+def connection_pool_size():
+    """Size of the HTTP connection pool of the current Cytomine session."""
+    try:
+        cytomine = Cytomine.get_instance()
+        adapter = cytomine._session.get_adapter(cytomine._base_url())
+        return adapter._pool_maxsize
+    except Exception:
+        return DEFAULT_POOL_SIZE
+
+
+def parse_stage_limits(value):
+    """Parse stage limits given on the command line as `stage=limit,stage=limit`."""
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        return value
+    limits = {}
+    for item in value.split(","):
+        stage, _, limit = item.partition("=")
+        limits[stage.strip()] = int(limit)
+    return limits
+
+
+class Stage:
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.semaphore = threading.BoundedSemaphore(limit)
+
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+        self.count = 0
+        self.busy_time = 0
+        self.wait_time = 0
+        self.started = None
+        self.finished = None
+
+    def enter(self, wait_time):
+        with self._lock:
+            now = time.time()
+            if self.started is None:
+                self.started = now
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            self.count += 1
+            self.wait_time += wait_time
+            return now
+
+    def leave(self, entered):
+        with self._lock:
+            now = time.time()
+            self.in_flight -= 1
+            self.busy_time += now - entered
+            self.finished = now
+
+    @property
+    def utilization(self):
+        if self.started is None or self.finished is None or self.finished <= self.started:
+            return 0
+        return self.busy_time / (self.limit * (self.finished - self.started))
+
+
+class Governor:
+    """
+    Bound the I/O concurrency of a whole migration run. At most `max_in_flight` requests (by default, the size of
+    the HTTP connection pool) are in flight at any time, and at most `max_rate` requests per second are started.
+    Each stage (metadata, download, upload, annotation...) gets its own share of the in-flight slots, and reports
+    how much of it has been used. A slot is held for one request (see `Resilience.call`), not for the whole work
+    on an item: the stage of a request is the one the current thread is working for.
+    """
+    def __init__(self, max_in_flight=None, max_rate=None, stage_limits=None):
+        pool_size = connection_pool_size()
+        self.max_in_flight = int(max_in_flight) if max_in_flight else pool_size
+        if self.max_in_flight > pool_size:
+            logging.warning("{} requests in flight allowed, but the HTTP connection pool only holds {} connections."
+                            .format(self.max_in_flight, pool_size))
+        self.max_rate = float(max_rate) if max_rate else None
+        self.stage_limits = parse_stage_limits(stage_limits)
+
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._local = threading.local()
+        self._stages = {}
+        self._stages_lock = threading.Lock()
+        self._rate_lock = threading.Lock()
+        self._next_request = 0
+
+    def _default_limit(self, name):
+        transfer_limit = max(1, int(self.max_in_flight * TRANSFER_SHARE))
+        if name in TRANSFER_STAGES:
+            return transfer_limit
+        transfer_limit = max(int(self.stage_limits.get(stage, transfer_limit)) for stage in TRANSFER_STAGES)
+        return self.max_in_flight - transfer_limit
+
+    def stage(self, name):
+        with self._stages_lock:
+            if name not in self._stages:
+                limit = min(int(self.stage_limits.get(name, self._default_limit(name))), self.max_in_flight)
+                self._stages[name] = Stage(name, max(1, limit))
+            return self._stages[name]
+
+    def current_stage(self):
+        return getattr(self._local, "stage", None) or "main"
+
+    @contextmanager
+    def working_for(self, name):
+        """Make the requests of the current thread count in the given stage."""
+        previous = getattr(self._local, "stage", None)
+        self._local.stage = name
+        try:
+            yield
+        finally:
+            self._local.stage = previous
+
+    def workers(self, name):
+        """Number of workers worth running for a stage."""
+        return self.stage(name).limit
+
+    def throttle(self):
+        """Wait until a new request can be started without exceeding the request rate."""
+        if not self.max_rate:
+            return
+        with self._rate_lock:
+            now = time.time()
+            start = max(now, self._next_request)
+            self._next_request = start + 1 / self.max_rate
+        if start > now:
+            time.sleep(start - now)
+
+    @contextmanager
+    def slot(self, name=None):
+        """
+        Hold one in-flight slot of the given stage (by default, the current one) and of the whole run. A thread
+        already holding a slot does not take another one.
+        """
+        if getattr(self._local, "holding", False):
+            yield
+            return
+
+        stage = self.stage(name if name else self.current_stage())
+        waiting = time.time()
+        with stage.semaphore:
+            with self._slots:
+                entered = stage.enter(time.time() - waiting)
+                self._local.holding = True
+                try:
+                    yield
+                finally:
+                    self._local.holding = False
+                    stage.leave(entered)
+
+    def map(self, name, fn, items):
+        """Call `fn` on every item with as many workers as the stage share, their requests counting in the stage."""
+        @profiled
+        def _governed(item):
+            with self.working_for(name):
+                return fn(item)
+
+        with ThreadPoolExecutor(max_workers=self.workers(name)) as executor:
+            return list(executor.map(_governed, items))
+
+    def report(self):
+        for name in sorted(self._stages.keys()):
+            stage = self._stages[name]
+            logging.info("Stage {}: {} calls, limit {}, peak {} in flight, {:.0%} utilization, "
+                         "{:.1f}s waiting for a slot".format(name, stage.count, stage.limit, stage.peak,
+                                                             stage.utilization, stage.wait_time))
@@ -38,15 +38,36 @@ if __name__ == '__main__':
     parser.add_argument('--private_key', help="The Cytomine private key used to import the project. "
                                               "The underlying user has to be a Cytomine administrator.")
     parser.add_argument('--project_path', default="", help="The base path where the project archive is stored.")
+    parser.add_argument('--max_retries', default=5, help="Number of retries of a failed request before giving up.")
+    parser.add_argument('--retry_delay', default=1, help="Base delay (in seconds) of the exponential backoff "
+                                                         "between retries.")
+    parser.add_argument('--max_connections', default=None, help="Maximum number of requests in flight for the whole "
+                                                               "run (default: size of the HTTP connection pool).")
+    parser.add_argument('--max_request_rate', default=None, help="Maximum number of requests started per second.")
+    parser.add_argument('--stage_limits', default=None, help="Maximum number of requests in flight per stage, as "
+                                                             "stage=limit pairs (e.g. annotation=6,upload=2).")
+    parser.add_argument('--annotation_max_in_memory', default=50000, help="Maximum number of annotations held in "
+                                                                          "memory while importing them, the others "
+                                                                          "being spilled to disk.")
+    parser.add_argument('--plan', default=False, help="Do not import anything but write the import plan of every "
+                                                      "project, with request and byte counts per stage, next to "
+                                                      "its directory.")
+    parser.add_argument('--profile', default=False, help="Profile CPU time and memory allocations of every stage of "
+                                                         "the imports.")
     # TODO: other options
     params, other = parser.parse_known_args(sys.argv[1:])
 
     with Cytomine(params.host, params.public_key, params.private_key) as _:
-        options = {k:v for (k,v) in vars(params).items() if k.startswith('without')}
+        options = {k:v for (k,v) in vars(params).items() if k.startswith('without')
+                   or k in ('max_retries', 'retry_delay', 'max_connections', 'max_request_rate', 'stage_limits',
+                            'profile', 'annotation_max_in_memory')}
 
         for file in os.listdir(params.project_path):
             abs_path = os.path.join(params.project_path, file)
             if os.path.isdir(abs_path):
                 print(abs_path)
                 importer = Importer(params.host_upload, abs_path, **options)
-                importer.run()
\ No newline at end of file
+                if params.plan:
+                    importer.plan()
+                else:
+                    importer.run()
\ No newline at end of file
@@ -30,15 +30,24 @@ import sys
 import tarfile
 import time
 from argparse import ArgumentParser
+from collections import OrderedDict
 
 import requests
 from cytomine import Cytomine
 from cytomine.models import OntologyCollection, TermCollection, User, RelationTerm, ProjectCollection, \
     StorageCollection, AbstractImageCollection, ImageInstance, ImageInstanceCollection, AbstractImage, UserCollection, \
-    Ontology, Project, Term, AnnotationCollection, Annotation, Property, Model, AttachedFile, Description, \
-    ImageGroupCollection, ImageGroup, ImageSequenceCollection, ImageSequence, DisciplineCollection
+    Ontology, Project, Term, Annotation, Property, Model, AttachedFile, Description, AnnotationCollection, \
+    PropertyCollection, AttachedFileCollection, ImageGroupCollection, ImageGroup, ImageSequenceCollection, \
+    ImageSequence, DisciplineCollection
 from cytomine.models.image import SliceInstanceCollection, SliceInstance
-from joblib import Parallel, delayed
+
+from cytomineprojectmigrator.archive import ArchiveReader
+from cytomineprojectmigrator.batch import expand_items, run_batch
+from cytomineprojectmigrator.fingerprint import FingerprintIndex
+from cytomineprojectmigrator.governor import Governor
+from cytomineprojectmigrator.profiling import StageProfiler
+from cytomineprojectmigrator.reader import GroupedRecordReader, iter_json_array
+from cytomineprojectmigrator.resilience import Resilience
 
 __author__ = "Rubens Ulysse <urubens@uliege.be>"
 
@@ -51,6 +60,27 @@ def random_string(length=10):
     return ''.join(random.choice(string.ascii_letters) for _ in range(length))
 
 
+def lookup(fetch, **attributes):
+    """
+    Return a function finding, in the collection returned by `fetch`, the object having the given attribute
+    values (None if there is none). Used to check whether a failed create request has been committed.
+    """
+    def _lookup():
+        objects = fetch()
+        if objects is False:
+            return False
+        return find_first([o for o in objects if all(getattr(o, k, None) == v for k, v in attributes.items())])
+    return _lookup
+
+
+def domain_object(class_name, id):
+    """The object a property, description or attached file is attached to, for the requests listing them."""
+    obj = Model()
+    obj.id = id
+    obj.class_ = class_name
+    return obj
+
+
 def connect_as(user=None, open_admin_session=False):
     public_key = None
     private_key = None
@@ -71,11 +101,94 @@ def connect_as(user=None, open_admin_session=False):
     return Cytomine.get_instance().current_user
 
 
+def fetch_archive(project_path):
+    """Download (if it is an URL) and extract (if it is a tarball) a project archive, and return its directory."""
+    if project_path.startswith("http://") or project_path.startswith("https://"):
+        logging.info("Downloading from {}".format(project_path))
+        response = requests.get(project_path, allow_redirects=True, stream=True)
+        project_path = project_path[project_path.rfind("/") + 1 :]
+        with open(project_path, "wb") as f:
+            shutil.copyfileobj(response.raw, f)
+            logging.info("Downloaded successfully.")
+
+    if project_path.endswith(".tar.gz") or project_path.endswith(".tar"):
+        compressed = project_path.endswith(".tar.gz")
+        tar = tarfile.open(project_path, "r:gz" if compressed else "r:")
+        tar.extractall(os.path.dirname(project_path))
+        tar.close()
+        project_path = project_path[:-7] if compressed else project_path[:-4]
+    return project_path
+
+
+def find_compatible_ontology(remote_ontology, remote_terms, ontologies, terms):
+    """
+    Return the name to give to the imported ontology, and the existing ontology with this name and the same terms
+    if any. When an ontology with the same name but different terms exists, a (x) suffix is added to the name.
+    """
+    def ontology_exists(name):
+        compatible_ontology = find_first([o for o in ontologies if o.name == name.strip()])
+        if compatible_ontology:
+            set1 = set((t.name, t.color) for t in terms if t.ontology == compatible_ontology.id)
+            difference = [term for term in remote_terms if (term.name, term.color) not in set1]
+            if len(difference) == 0:
+                return True, compatible_ontology
+            return False, None
+        else:
+            return True, None
+
+    i = 1
+    name = remote_ontology.name
+    found, existing_ontology = ontology_exists(name)
+    while not found:
+        name = "{} ({})".format(remote_ontology.name, i)
+        found, existing_ontology = ontology_exists(name)
+        i += 1
+    return name, existing_ontology
+
+
+def available_name(name, existing_names):
+    i = 1
+    new_name = name
+    while new_name in existing_names:
+        new_name = "{} ({})".format(name, i)
+        i += 1
+    return new_name
+
+
+def find_abstract_image(abstract_images, remote_image):
+    return find_first([ai for ai in abstract_images
+                       if ai.originalFilename == remote_image.originalFilename
+                       and ai.width == remote_image.width
+                       and ai.height == remote_image.height
+                       and ai.physicalSizeX == remote_image.physicalSizeX])
+
+
 class Importer:
-    def __init__(self, host_upload, working_path, with_original_date=False):
+    def __init__(self, host_upload, working_path, with_original_date=False, annotation_batch_size=1000,
+                 resilience=None, max_retries=5, retry_delay=1, governor=None, max_connections=None,
+                 max_request_rate=None, stage_limits=None, profile=False, profile_path=None,
+                 annotation_max_in_memory=50000):
         self.host_upload = host_upload
         self.with_original_date = with_original_date
+        self.annotation_batch_size = annotation_batch_size
+        self.annotation_max_in_memory = int(annotation_max_in_memory)
+
+        if governor is None:
+            governor = Governor(max_in_flight=max_connections, max_rate=max_request_rate, stage_limits=stage_limits)
+        self.governor = governor
+
+        if resilience is None:
+            resilience = Resilience(max_retries=int(max_retries), base_delay=float(retry_delay),
+                                    dead_letter_path=os.path.join(working_path, "dead-letters.jsonl"),
+                                    governor=self.governor)
+        self.resilience = resilience
         self.id_mapping = {}
+        self.archive = ArchiveReader(working_path)
+
+        if profile and profile_path is None:
+            # Inside the project directory: a sibling directory would be taken for a project by import_all.
+            profile_path = os.path.join(working_path, "profile")
+        self.profiler = StageProfiler(profile_path)
 
         self.working_path = working_path
 
@@ -84,12 +197,11 @@ class Importer:
 
         self.super_admin = None
 
-    def run(self):
-        self.super_admin = Cytomine.get_instance().current_user
-        connect_as(self.super_admin, True)
+    def json_files(self, prefix):
+        return self.archive.files(prefix)
 
-        users = UserCollection().fetch()
-        users_json = [f for f in os.listdir(self.working_path) if f.endswith(".json") and f.startswith("user-collection")][0]
+    def load_remote_users(self):
+        users_json = self.json_files("user-collection")[0]
         remote_users = UserCollection()
         for u in json.load(open(os.path.join(self.working_path, users_json))):
             remote_users.append(User().populate(u))
@@ -102,7 +214,16 @@ class Importer:
             roles += ["userannotation_creator", "userannotationterm_creator"]
 
         roles = set(roles)
-        remote_users = [u for u in remote_users if len(roles.intersection(set(u.roles))) > 0]
+        return [u for u in remote_users if len(roles.intersection(set(u.roles))) > 0]
+
+    def run(self):
+        self.profiler.stage("0/ Import users")
+        self.archive.verify()
+        self.super_admin = Cytomine.get_instance().current_user
+        connect_as(self.super_admin, True)
+
+        users = self.resilience.call(UserCollection().fetch)
+        remote_users = self.load_remote_users()
 
         for remote_user in remote_users:
             user = find_first([u for u in users if u.username == remote_user.username])
@@ -113,56 +234,42 @@ class Importer:
                 if not self.with_original_date:
                     user.created = None
                     user.updated = None
-                user.save()
+                user = self.resilience.create(user.save, lookup=lookup(lambda: UserCollection().fetch(),
+                                                                       username=user.username))
             self.id_mapping[remote_user.id] = user.id
 
         # --------------------------------------------------------------------------------------------------------------
-        logging.info("1/ Import ontology and terms")
+        self.profiler.stage("1/ Import ontology and terms")
         """
         Import the ontology with terms and relation terms that are stored in pickled files in working_path.
         If the ontology exists (same name and same terms), the existing one is used.
         Otherwise, an ontology with an available name is created with new terms and corresponding relationships.
         """
-        ontologies = OntologyCollection().fetch()
-        ontology_json = [f for f in os.listdir(self.working_path) if f.endswith(".json") and f.startswith("ontology")][0]
+        ontologies = self.resilience.call(OntologyCollection().fetch)
+        ontology_json = self.json_files("ontology")[0]
         remote_ontology = Ontology().populate(json.load(open(os.path.join(self.working_path, ontology_json))))
         remote_ontology.name = remote_ontology.name.strip()
 
-        terms = TermCollection().fetch()
-        terms_json = [f for f in os.listdir(self.working_path) if f.endswith(".json") and f.startswith("term-collection")]
+        terms = self.resilience.call(TermCollection().fetch)
+        terms_json = self.json_files("term-collection")
         remote_terms = TermCollection()
         if len(terms_json) > 0:
             for t in json.load(open(os.path.join(self.working_path, terms_json[0]))):
                 remote_terms.append(Term().populate(t))
 
-        def ontology_exists():
-            compatible_ontology = find_first([o for o in ontologies if o.name == remote_ontology.name.strip()])
-            if compatible_ontology:
-                set1 = set((t.name, t.color) for t in terms if t.ontology == compatible_ontology.id)
-                difference = [term for term in remote_terms if (term.name, term.color) not in set1]
-                if len(difference) == 0:
-                    return True, compatible_ontology
-                return False, None
-            else:
-                return True, None
-
-        i = 1
-        remote_name = remote_ontology.name
-        found, existing_ontology = ontology_exists()
-        while not found:
-            remote_ontology.name = "{} ({})".format(remote_name, i)
-            found, existing_ontology = ontology_exists()
-            i += 1
+        remote_ontology.name, existing_ontology = find_compatible_ontology(remote_ontology, remote_terms,
+                                                                           ontologies, terms)
 
         # SWITCH to ontology creator user
-        connect_as(User().fetch(self.id_mapping[remote_ontology.user]))
+        connect_as(self.resilience.call(User().fetch, self.id_mapping[remote_ontology.user]))
         if not existing_ontology:
             ontology = copy.copy(remote_ontology)
             ontology.user = self.id_mapping[remote_ontology.user]
             if not self.with_original_date:
                 ontology.created = None
                 ontology.updated = None
-            ontology.save()
+            ontology = self.resilience.create(ontology.save, lookup=lookup(lambda: OntologyCollection().fetch(),
+                                                                           name=ontology.name))
             self.id_mapping[remote_ontology.id] = ontology.id
             logging.info("Ontology imported: {}".format(ontology))
 
@@ -174,7 +281,8 @@ class Importer:
                 if not self.with_original_date:
                     term.created = None
                     term.updated = None
-                term.save()
+                term = self.resilience.create(term.save, lookup=lookup(
+                    lambda: TermCollection().fetch_with_filter("ontology", term.ontology), name=term.name))
                 self.id_mapping[remote_term.id] = term.id
                 logging.info("Term imported: {}".format(term))
 
@@ -182,7 +290,10 @@ class Importer:
             for relation in remote_relation_terms:
                 parent, child = relation
                 if parent:
-                    rt = RelationTerm(self.id_mapping[parent], self.id_mapping[child]).save()
+                    id_parent, id_child = self.id_mapping[parent], self.id_mapping[child]
+                    rt = self.resilience.attempt_create("relation_term", {"parent": id_parent, "child": id_child},
+                                                        RelationTerm(id_parent, id_child).save,
+                                                        lookup=lambda: RelationTerm().fetch(id_parent, id_child))
                     logging.info("Relation term imported: {}".format(rt))
         else:
             self.id_mapping[remote_ontology.id] = existing_ontology.id
@@ -197,29 +308,20 @@ class Importer:
         connect_as(self.super_admin, True)
 
         # --------------------------------------------------------------------------------------------------------------
-        logging.info("2/ Import project")
+        self.profiler.stage("2/ Import project")
         """
         Import the project (i.e. the Cytomine Project domain) stored in pickled file in working_path.
         If a project with the same name already exists, append a (x) suffix where x is an increasing number.
         """
-        disciplines = DisciplineCollection().fetch()
+        disciplines = self.resilience.call(DisciplineCollection().fetch)
 
-        projects = ProjectCollection().fetch()
-        project_json = [f for f in os.listdir(self.working_path) if f.endswith(".json") and f.startswith("project")][0]
+        projects = self.resilience.call(ProjectCollection().fetch)
+        project_json = self.json_files("project")[0]
         remote_project = Project().populate(json.load(open(os.path.join(self.working_path, project_json))))
         remote_project.name = remote_project.name.strip()
 
-        def available_name():
-            i = 1
-            existing_names = [o.name for o in projects]
-            new_name = project.name
-            while new_name in existing_names:
-                new_name = "{} ({})".format(project.name, i)
-                i += 1
-            return new_name
-
         project = copy.copy(remote_project)
-        project.name = available_name()
+        project.name = available_name(project.name, [o.name for o in projects])
         project.discipline = find_first([d.id for d in disciplines if d.name == project.disciplineName])
         project.ontology = self.id_mapping[project.ontology]
         project_contributors = [u for u in remote_users if "project_contributor" in u.roles]
@@ -229,17 +331,17 @@ class Importer:
         if not self.with_original_date:
             project.created = None
             project.updated = None
-        project.save()
+        project = self.resilience.create(project.save, lookup=lookup(lambda: ProjectCollection().fetch(),
+                                                                     name=project.name))
         self.id_mapping[remote_project.id] = project.id
         logging.info("Project imported: {}".format(project))
 
         # --------------------------------------------------------------------------------------------------------------
-        logging.info("3/ Import images")
-        storages = StorageCollection(all=True).fetch()
-        abstract_images = AbstractImageCollection().fetch()
+        self.profiler.stage("3/ Import images")
+        storages = self.resilience.call(StorageCollection(all=True).fetch)
+        abstract_images = self.resilience.call(AbstractImageCollection().fetch)
 
-        groups_json = [f for f in os.listdir(self.working_path) if f.endswith(".json")
-                       and f.startswith("imagegroup-collection")]
+        groups_json = self.json_files("imagegroup-collection")
         remote_groups = ImageGroupCollection()
         if len(groups_json) > 0:
             for i in json.load(open(os.path.join(self.working_path, groups_json[0]))):
@@ -247,8 +349,7 @@ class Importer:
 
         if len(remote_groups) > 0:
             # Get image sequences.
-            sequences_json = [f for f in os.listdir(self.working_path) if f.endswith(".json")
-                           and f.startswith("imagesequence-collection")]
+            sequences_json = self.json_files("imagesequence-collection")
             remote_sequences = ImageSequenceCollection()
             if len(sequences_json) > 0:
                 for i in json.load(open(os.path.join(self.working_path, sequences_json[0]))):
@@ -270,7 +371,7 @@ class Importer:
                 first_seq = find_first([s for s in remote_sequences if s.imageGroup == remote_group.id])
 
                 # SWITCH user to image creator user
-                connect_as(User().fetch(self.id_mapping[first_seq.model['user']]))
+                connect_as(self.resilience.call(User().fetch, self.id_mapping[first_seq.model['user']]))
                 # Get its storage
                 storage = find_first([s for s in storages if s.user == Cytomine.get_instance().current_user.id])
                 if not storage:
@@ -278,8 +379,11 @@ class Importer:
 
                 logging.info("== New image starting to upload & deploy")
                 filename = os.path.join(self.working_path, "imagegroups", group.name.replace("/", "-"))
-                Cytomine.get_instance().upload_image(self.host_upload, filename, storage.id,
-                                                     self.id_mapping[remote_project.id])
+                with self.governor.working_for("upload"):
+                    self.resilience.attempt_create("image_upload", {"filename": filename,
+                                                                    "project": self.id_mapping[remote_project.id]},
+                                                   Cytomine.get_instance().upload_image, self.host_upload, filename,
+                                                   storage.id, self.id_mapping[remote_project.id])
                 time.sleep(0.8)
 
                 # SWITCH USER
@@ -290,7 +394,8 @@ class Importer:
             count = 0
             new_groups = None
             while n_new_groups != len(remote_groups) and count < len(remote_groups) * 5:
-                new_groups = ImageGroupCollection().fetch_with_filter("project", self.id_mapping[remote_project.id])
+                new_groups = self.resilience.call(ImageGroupCollection().fetch_with_filter, "project",
+                                                  self.id_mapping[remote_project.id])
                 n_new_groups = len(new_groups)
                 if count > 0:
                     time.sleep(5)
@@ -302,15 +407,13 @@ class Importer:
                 if self.with_original_date:
                     new_group.created = remote_group.created
                     new_group.updated = remote_group.updated
-                new_group.update()
+                self.resilience.attempt("imagegroup_update", json.loads(new_group.to_json()), new_group.update)
                 self.id_mapping[remote_group.id] = new_group.id
 
             print("All image groups have been fixed.")
         else:
-            images_json = [f for f in os.listdir(self.working_path) if f.endswith(".json")
-                           and f.startswith("imageinstance-collection")]
-            slices_json = [f for f in os.listdir(self.working_path) if f.endswith(".json")
-                           and f.startswith("sliceinstance-collection")]
+            images_json = self.json_files("imageinstance-collection")
+            slices_json = self.json_files("sliceinstance-collection")
             remote_images = ImageInstanceCollection()
             remote_slices = SliceInstanceCollection()
             if len(images_json) > 0:
@@ -323,53 +426,102 @@ class Importer:
 
             remote_images_dict = {}
 
+            # Identical files are uploaded once, other images are linked to the resulting abstract image. A file
+            # identical to one already in a storage (e.g. deployed by a previous import attempt) is not uploaded.
+            fingerprints = FingerprintIndex(self.working_path, directories=("images",))
+            uploaded = {}
+            existing = {}
+            duplicates = []
+            saved_bytes = 0
+
             for remote_image in remote_images:
                 image = copy.copy(remote_image)
 
                 # Fix old image name due to urllib3 limitation
                 remote_image.originalFilename = bytes(remote_image.originalFilename, 'utf-8').decode('ascii', 'ignore')
-                if remote_image.originalFilename not in remote_images_dict.keys():
-                    remote_images_dict[remote_image.originalFilename] = [remote_image]
-                else:
-                    remote_images_dict[remote_image.originalFilename].append(remote_image)
                 logging.info("Importing image: {}".format(remote_image))
 
                 # SWITCH user to image creator user
-                connect_as(User().fetch(self.id_mapping[remote_image.user]))
+                connect_as(self.resilience.call(User().fetch, self.id_mapping[remote_image.user]))
                 # Get its storage
                 storage = find_first([s for s in storages if s.user == Cytomine.get_instance().current_user.id])
                 if not storage:
                     storage = storages[0]
 
+                filename = os.path.join(self.working_path, "images", image.originalFilename.replace("/", "-"))
+                fingerprint = fingerprints.key(filename)
+
                 # Check if image is already in its storage
-                abstract_image = find_first([ai for ai in abstract_images
-                                             if ai.originalFilename == remote_image.originalFilename
-                                             and ai.width == remote_image.width
-                                             and ai.height == remote_image.height
-                                             and ai.physicalSizeX == remote_image.physicalSizeX])
+                abstract_image = find_abstract_image(abstract_images, remote_image)
+                if abstract_image and fingerprint:
+                    existing.setdefault(fingerprint, abstract_image)
+                elif fingerprint in existing:
+                    abstract_image = existing[fingerprint]
+                    logging.info("== Same file as abstract image {} already in storage.".format(abstract_image.id))
+                    saved_bytes += fingerprints.size(filename)
+
+                # Filename of the image instance that will be created in the project.
+                instance_filename = remote_image.originalFilename
                 if abstract_image:
                     logging.info("== Found corresponding abstract image. Linking to project.")
-                    ImageInstance(abstract_image.id, self.id_mapping[remote_project.id]).save()
+                    instance_filename = abstract_image.originalFilename
+                    self._link_image(abstract_image.id, self.id_mapping[remote_project.id])
+                elif fingerprint in uploaded:
+                    logging.info("== Same file as image {} already uploaded, will be linked once deployed."
+                                 .format(uploaded[fingerprint].id))
+                    instance_filename = uploaded[fingerprint].originalFilename
+                    duplicates.append((remote_image, fingerprint))
+                    saved_bytes += fingerprints.size(filename)
                 else:
                     logging.info("== New image starting to upload & deploy")
-                    filename = os.path.join(self.working_path, "images", image.originalFilename.replace("/", "-"))
-                    Cytomine.get_instance().upload_image(self.host_upload, filename, storage.id,
-                                                         self.id_mapping[remote_project.id])
+                    if fingerprint:
+                        uploaded[fingerprint] = remote_image
+                    with self.governor.working_for("upload"):
+                        self.resilience.attempt_create("image_upload",
+                                                       {"filename": filename,
+                                                        "project": self.id_mapping[remote_project.id]},
+                                                       Cytomine.get_instance().upload_image, self.host_upload,
+                                                       filename, storage.id, self.id_mapping[remote_project.id])
                     time.sleep(0.8)
 
+                remote_images_dict.setdefault(instance_filename, []).append(remote_image)
+
                 # SWITCH USER
                 connect_as(self.super_admin, True)
 
+            def _wait_for_images(n_expected):
+                n_new_images = -1
+                new_images = None
+                count = 0
+                while n_new_images != n_expected and count < n_expected * 5:
+                    new_images = self.resilience.call(ImageInstanceCollection().fetch_with_filter, "project",
+                                                      self.id_mapping[remote_project.id])
+                    n_new_images = len(new_images)
+                    if count > 0:
+                        time.sleep(5)
+                    count = count + 1
+                return new_images
+
             # Waiting for all images...
-            n_new_images = -1
-            new_images = None
-            count = 0
-            while n_new_images != len(remote_images) and count < len(remote_images) * 5:
-                new_images = ImageInstanceCollection().fetch_with_filter("project", self.id_mapping[remote_project.id])
-                n_new_images = len(new_images)
-                if count > 0:
-                    time.sleep(5)
-                count = count + 1
+            new_images = _wait_for_images(len(remote_images) - len(duplicates))
+
+            if len(duplicates) > 0:
+                base_images = {new_image.originalFilename: new_image.baseImage for new_image in new_images}
+                for remote_image, fingerprint in duplicates:
+                    base_image = base_images.get(uploaded[fingerprint].originalFilename)
+                    if not base_image:
+                        logging.error("Cannot link image {}: its file has not been deployed.".format(remote_image.id))
+                        continue
+
+                    # SWITCH user to image creator user
+                    connect_as(self.resilience.call(User().fetch, self.id_mapping[remote_image.user]))
+                    self._link_image(base_image, self.id_mapping[remote_project.id])
+                    # SWITCH USER
+                    connect_as(self.super_admin, True)
+                new_images = _wait_for_images(len(remote_images))
+
+            logging.info("Deduplication: {} duplicate files in the archive, {} bytes not uploaded."
+                         .format(len(duplicates), saved_bytes))
             print("All images have been deployed. Fixing image-instances...")
 
             # Fix image instances meta-data:
@@ -382,11 +534,11 @@ class Importer:
                 new_image.reviewStop = remote_image.reviewStop if hasattr(remote_image, 'reviewStop') else None
                 new_image.reviewUser = self.id_mapping[remote_image.reviewUser] if hasattr(remote_image, 'reviewUser') and remote_image.reviewUser else None
                 new_image.instanceFilename = remote_image.instanceFilename
-                new_image.update()
+                self.resilience.attempt("image_update", json.loads(new_image.to_json()), new_image.update)
                 self.id_mapping[remote_image.id] = new_image.id
                 self.id_mapping[remote_image.baseImage] = new_image.baseImage
 
-                new_abstract = AbstractImage().fetch(new_image.baseImage)
+                new_abstract = self.resilience.call(AbstractImage().fetch, new_image.baseImage)
                 if self.with_original_date:
                     new_abstract.created = remote_image.created
                     new_abstract.updated = remote_image.updated
@@ -394,9 +546,11 @@ class Importer:
                     new_abstract.physicalSizeX = remote_image.physicalSizeX
                 if new_abstract.magnification is None:
                     new_abstract.magnification = remote_image.magnification
-                new_abstract.update()
+                self.resilience.attempt("abstract_image_update", json.loads(new_abstract.to_json()),
+                                        new_abstract.update)
 
-                slices = SliceInstanceCollection().fetch_with_filter("imageinstance", new_image.id)
+                slices = self.resilience.call(SliceInstanceCollection().fetch_with_filter, "imageinstance",
+                                              new_image.id)
                 for remote_slice in [s for s in remote_slices if s.image == remote_image.id]:
                     new_slice = find_first([s for s in slices if s.channel == remote_slice.channel
                                             and s.zStack == remote_slice.zStack and s.time == remote_slice.time])
@@ -406,14 +560,12 @@ class Importer:
             print("All image-instances have been fixed.")
 
         # --------------------------------------------------------------------------------------------------------------
-        logging.info("4/ Import user annotations")
-        annots_json = [f for f in os.listdir(self.working_path) if f.endswith(".json") and f.startswith("user-annotation-collection")]
-        remote_annots = AnnotationCollection()
-        if len(annots_json) > 0:
-            for a in json.load(open(os.path.join(self.working_path, annots_json[0]))):
-                remote_annots.append(Annotation().populate(a))
+        self.profiler.stage("4/ Import user annotations")
+        annots_json = self.json_files("user-annotation-collection")
 
-        def _add_annotation(remote_annotation, id_mapping, with_original_date):
+        def _add_annotation(remote_annotation):
+            id_mapping = self.id_mapping
+            with_original_date = self.with_original_date
             if remote_annotation.project not in id_mapping.keys() \
                     or remote_annotation.image not in id_mapping.keys():
                 return
@@ -427,66 +579,230 @@ class Importer:
             if not with_original_date:
                 annotation.created = None
                 annotation.updated = None
-            annotation.save()
+            existing = lookup(AnnotationCollection(project=annotation.project, image=annotation.image,
+                                                   user=annotation.user, showWKT=True).fetch,
+                              location=annotation.location)
+            self.resilience.attempt_create("annotation", json.loads(annotation.to_json()), annotation.save,
+                                           lookup=existing)
 
-        for user in [u for u in remote_users if "userannotation_creator" in u.roles]:
-            remote_annots_for_user = [a for a in remote_annots if a.user == user.id]
-            # SWITCH to annotation creator user
-            connect_as(User().fetch(self.id_mapping[user.id]))
-            Parallel(n_jobs=-1, backend="threading")(delayed(_add_annotation)
-                                                     (remote_annotation, self.id_mapping, self.with_original_date)
-                                                     for remote_annotation in remote_annots_for_user)
+        if len(annots_json) > 0:
+            annotation_creators = set([u.id for u in remote_users if "userannotation_creator" in u.roles])
+            reader = GroupedRecordReader(os.path.join(self.working_path, annots_json[0]), key="user",
+                                         batch_size=self.annotation_batch_size,
+                                         max_in_memory=self.annotation_max_in_memory, spill_path=self.working_path)
+            current_user = None
+            for user_id, batch in reader:
+                if user_id not in annotation_creators:
+                    continue
+
+                if user_id != current_user:
+                    # SWITCH to annotation creator user
+                    connect_as(self.resilience.call(User().fetch, self.id_mapping[user_id]))
+                    current_user = user_id
+
+                remote_annots = [Annotation().populate(a) for a in batch]
+                self.governor.map("annotation", _add_annotation, remote_annots)
 
             # SWITCH back to admin
             connect_as(self.super_admin, True)
 
         # --------------------------------------------------------------------------------------------------------------
-        logging.info("5/ Import metadata (properties, attached files, description)")
+        self.profiler.stage("5/ Import metadata (properties, attached files, description)")
         obj = Model()
         obj.id = -1
         obj.class_ = ""
 
-        properties_json = [f for f in os.listdir(self.working_path) if
-                       f.endswith(".json") and f.startswith("properties")]
-        for property_json in properties_json:
-            for remote_prop in json.load(open(os.path.join(self.working_path, property_json))):
-                prop = Property(obj).populate(remote_prop)
-                prop.domainIdent = self.id_mapping[prop.domainIdent]
-                prop.save()
+        for remote_prop in self.archive.records("properties"):
+            prop = Property(obj).populate(remote_prop)
+            prop.domainIdent = self.id_mapping[prop.domainIdent]
+            target = domain_object(prop.domainClassName, prop.domainIdent)
+            self.resilience.attempt_create("property", json.loads(prop.to_json()), prop.save,
+                                           lookup=lookup(PropertyCollection(target).fetch, key=prop.key))
 
         new_descriptions = []
-        descriptions_json = [f for f in os.listdir(self.working_path) if f.endswith(".json") and f.startswith("description")]
-        for description_json in descriptions_json:
-            desc = Description(obj).populate(json.load(open(os.path.join(self.working_path, description_json))))
+        for remote_desc in self.archive.records("description"):
+            desc = Description(obj).populate(remote_desc)
             desc_id = desc.id
             desc.domainIdent = self.id_mapping[desc.domainIdent]
             desc._object.class_ = desc.domainClassName
             desc._object.id = desc.domainIdent
-            new_desc = desc.save()
-            self.id_mapping[desc_id] = new_desc.id
-            new_descriptions.append(new_desc)
+            target = domain_object(desc.domainClassName, desc.domainIdent)
+            new_desc = self.resilience.attempt_create("description", json.loads(desc.to_json()), desc.save,
+                                                      lookup=Description(target).fetch)
+            if new_desc:
+                self.id_mapping[desc_id] = new_desc.id
+                new_descriptions.append(new_desc)
 
         attached_file_id_mapping = {}
-        attached_files_json = [f for f in os.listdir(self.working_path) if
-                               f.endswith(".json") and f.startswith("attached-files")]
-        for attached_file_json in attached_files_json:
-            for remote_af in json.load(open(os.path.join(self.working_path, attached_file_json))):
-                af = AttachedFile(obj).populate(remote_af)
-                af.domainIdent = self.id_mapping[af.domainIdent]
-                af.filename = os.path.join(self.working_path, "attached_files", af.filename)
-                af_id = af.id
-                af.id = None
-                new_af = af.save()
-                if new_af:
-                    attached_file_id_mapping[af_id] = new_af.id
-                else:
-                    print("ERROR: attached file {}".format(remote_af))
+        for remote_af in self.archive.records("attached-files"):
+            af = AttachedFile(obj).populate(remote_af)
+            af.domainIdent = self.id_mapping[af.domainIdent]
+            af.filename = os.path.join(self.working_path, "attached_files", af.filename)
+            af_id = af.id
+            af.id = None
+            target = domain_object(af.domainClassName, af.domainIdent)
+            new_af = self.resilience.attempt_create("attached_file", json.loads(af.to_json()), af.save,
+                                                    lookup=lookup(AttachedFileCollection(target).fetch,
+                                                                  filename=os.path.basename(af.filename)))
+            if new_af:
+                attached_file_id_mapping[af_id] = new_af.id
 
         for description in new_descriptions:
             if "attachedfile/" in description.data:
                 for (id, new_id) in attached_file_id_mapping.items():
                     description.data = description.data.replace("attachedfile/{}".format(id), "attachedfile/{}".format(new_id))
-                description.update()
+                self.resilience.attempt("description_update", json.loads(description.to_json()), description.update)
+
+        self.resilience.report()
+        self.governor.report()
+        self.profiler.close()
+
+    def _link_image(self, id_abstract_image, id_project):
+        """Add an abstract image to a project, unless a retry finds the image instance already created."""
+        self.resilience.attempt_create("image_link", {"baseImage": id_abstract_image, "project": id_project},
+                                       ImageInstance(id_abstract_image, id_project).save,
+                                       lookup=lookup(lambda: ImageInstanceCollection().fetch_with_filter(
+                                           "project", id_project), baseImage=id_abstract_image))
+
+    def plan(self, plan_path=None, request_time=0.2, upload_rate=20 * 1024 * 1024):
+        """
+        Dry-run of `run`: read the archive and the destination collections, and write a machine-readable plan of
+        what would be reused or created, with request and byte counts per stage, and a rough duration estimate
+        (`request_time` seconds per request, `upload_rate` bytes per second). Nothing is changed on the destination.
+        """
+        self.archive.verify()
+        self.super_admin = Cytomine.get_instance().current_user
+        connect_as(self.super_admin, True)
+
+        stages = OrderedDict()
+
+        def _stage(stage_name, requests, n_bytes=0, workers=1, **details):
+            stage = OrderedDict([("requests", requests), ("bytes", n_bytes)])
+            stage["estimated_seconds"] = round(requests * request_time / workers + n_bytes / upload_rate, 1)
+            stage.update(details)
+            stages[stage_name] = stage
+
+        def _file_size(*path):
+            path = os.path.join(self.working_path, *path)
+            return os.path.getsize(path) if os.path.isfile(path) else 0
+
+        # --------------------------------------------------------------------------------------------------------------
+        users = self.resilience.call(UserCollection().fetch)
+        usernames = set(u.username for u in users)
+        remote_users = self.load_remote_users()
+        reused_users = [u.username for u in remote_users if u.username in usernames]
+        created_users = [u.username for u in remote_users if u.username not in usernames]
+        _stage("users", len(created_users), reused=reused_users, created=created_users)
+
+        # --------------------------------------------------------------------------------------------------------------
+        ontologies = self.resilience.call(OntologyCollection().fetch)
+        terms = self.resilience.call(TermCollection().fetch)
+        remote_ontology = Ontology().populate(json.load(open(os.path.join(self.working_path,
+                                                                          self.json_files("ontology")[0]))))
+        remote_ontology.name = remote_ontology.name.strip()
+        remote_terms = TermCollection()
+        terms_json = self.json_files("term-collection")
+        if len(terms_json) > 0:
+            for t in json.load(open(os.path.join(self.working_path, terms_json[0]))):
+                remote_terms.append(Term().populate(t))
+
+        name, existing_ontology = find_compatible_ontology(remote_ontology, remote_terms, ontologies, terms)
+        if existing_ontology:
+            _stage("ontology", 0, action="reuse", ontology=existing_ontology.id, name=existing_ontology.name)
+        else:
+            n_relations = len([t for t in remote_terms if t.parent])
+            _stage("ontology", 1 + len(remote_terms) + n_relations, action="create", name=name,
+                   terms=len(remote_terms), relation_terms=n_relations)
+
+        # --------------------------------------------------------------------------------------------------------------
+        projects = self.resilience.call(ProjectCollection().fetch)
+        remote_project = Project().populate(json.load(open(os.path.join(self.working_path,
+                                                                        self.json_files("project")[0]))))
+        _stage("project", 1, name=available_name(remote_project.name.strip(), [o.name for o in projects]))
+
+        # --------------------------------------------------------------------------------------------------------------
+        groups_json = self.json_files("imagegroup-collection")
+        remote_groups = json.load(open(os.path.join(self.working_path, groups_json[0]))) if groups_json else []
+        remote_image_ids = set()
+        if len(remote_groups) > 0:
+            n_bytes = sum(_file_size("imagegroups", g["name"].replace("/", "-")) for g in remote_groups)
+            _stage("images", 3 * len(remote_groups), n_bytes, uploads=len(remote_groups), image_groups=True)
+        else:
+            abstract_images = self.resilience.call(AbstractImageCollection().fetch)
+            fingerprints = FingerprintIndex(self.working_path, directories=("images",))
+
+            images_json = self.json_files("imageinstance-collection")
+            remote_images = json.load(open(os.path.join(self.working_path, images_json[0]))) if images_json else []
+            matched, uploads, duplicates = [], [], []
+            uploaded, existing, n_bytes, saved_bytes = set(), set(), 0, 0
+            for i in remote_images:
+                remote_image = ImageInstance().populate(i)
+                remote_image_ids.add(remote_image.id)
+                filename = os.path.join(self.working_path, "images", remote_image.originalFilename.replace("/", "-"))
+                remote_image.originalFilename = bytes(remote_image.originalFilename, 'utf-8').decode('ascii', 'ignore')
+                fingerprint = fingerprints.key(filename)
+
+                abstract_image = find_abstract_image(abstract_images, remote_image)
+                if abstract_image or fingerprint in existing:
+                    matched.append(remote_image.originalFilename)
+                    if not abstract_image:
+                        saved_bytes += fingerprints.size(filename)
+                    elif fingerprint:
+                        existing.add(fingerprint)
+                elif fingerprint in uploaded:
+                    duplicates.append(remote_image.originalFilename)
+                    saved_bytes += fingerprints.size(filename)
+                else:
+                    uploads.append(remote_image.originalFilename)
+                    n_bytes += fingerprints.size(filename)
+                    if fingerprint:
+                        uploaded.add(fingerprint)
+
+            # Upload or link, then fix the image instance and its abstract image, and map the slices.
+            n_requests = len(uploads) + len(matched) + len(duplicates) + 4 * len(remote_images)
+            _stage("images", n_requests, n_bytes, matched=matched, uploads=uploads, duplicates=duplicates,
+                   duplicate_bytes=saved_bytes)
+
+        # --------------------------------------------------------------------------------------------------------------
+        annotation_creators = set([u.id for u in remote_users if "userannotation_creator" in u.roles])
+        annots_json = self.json_files("user-annotation-collection")
+        n_annotations = 0
+        if len(annots_json) > 0:
+            for a in iter_json_array(os.path.join(self.working_path, annots_json[0])):
+                if a.get("user") in annotation_creators \
+                        and (len(remote_groups) > 0 or a.get("image") in remote_image_ids):
+                    n_annotations += 1
+        _stage("annotations", n_annotations, workers=self.governor.workers("annotation"), annotations=n_annotations)
+
+        # --------------------------------------------------------------------------------------------------------------
+        n_properties = self.archive.count("properties")
+        n_descriptions = self.archive.count("description")
+        n_attached_files, n_bytes = 0, 0
+        for af in self.archive.records("attached-files"):
+            n_attached_files += 1
+            n_bytes += _file_size("attached_files", af.get("filename", ""))
+        _stage("metadata", n_properties + 2 * n_descriptions + n_attached_files, n_bytes,
+               properties=n_properties, descriptions=n_descriptions, attached_files=n_attached_files)
+
+        plan = OrderedDict([
+            ("working_path", self.working_path),
+            ("assumptions", OrderedDict([("request_time", request_time), ("upload_rate", upload_rate)])),
+            ("total", OrderedDict([
+                ("requests", sum(s["requests"] for s in stages.values())),
+                ("bytes", sum(s["bytes"] for s in stages.values())),
+                ("estimated_seconds", round(sum(s["estimated_seconds"] for s in stages.values()), 1))
+            ])),
+            ("stages", stages)
+        ])
+
+        if plan_path is None:
+            plan_path = "{}-import-plan.json".format(os.path.normpath(self.working_path))
+        with open(plan_path, "w") as f:
+            json.dump(plan, f, indent=2)
+        logging.info("Import plan written to {}: {} requests, {} bytes to upload, ~{}s."
+                     .format(plan_path, plan["total"]["requests"], plan["total"]["bytes"],
+                             plan["total"]["estimated_seconds"]))
+        return plan
 
 
 if __name__ == '__main__':
@@ -497,31 +813,63 @@ if __name__ == '__main__':
                                              "The underlying user has to be a Cytomine administrator.")
     parser.add_argument('--private_key', help="The Cytomine private key used to import the project. "
                                               "The underlying user has to be a Cytomine administrator.")
-    parser.add_argument('--project_path', default="", help="The base path where the project archive is stored.")
+    parser.add_argument('--project_path', nargs='+', default=[""],
+                        help="The base path where the project archive is stored. Several archives, or .txt files "
+                             "listing one archive per line, are imported one after the other in the same process.")
+    parser.add_argument('--max_retries', default=5, help="Number of retries of a failed request before giving up.")
+    parser.add_argument('--retry_delay', default=1, help="Base delay (in seconds) of the exponential backoff "
+                                                         "between retries.")
+    parser.add_argument('--max_connections', default=None, help="Maximum number of requests in flight for the whole "
+                                                               "run (default: size of the HTTP connection pool).")
+    parser.add_argument('--max_request_rate', default=None, help="Maximum number of requests started per second.")
+    parser.add_argument('--stage_limits', default=None, help="Maximum number of requests in flight per stage, as "
+                                                             "stage=limit pairs (e.g. annotation=6,upload=2).")
+    parser.add_argument('--annotation_max_in_memory', default=50000, help="Maximum number of annotations held in "
+                                                                          "memory while importing them, the others "
+                                                                          "being spilled to disk.")
+    parser.add_argument('--plan', default=False, help="Do not import anything but write the import plan, with "
+                                                      "request and byte counts per stage.")
+    parser.add_argument('--plan_path', default=None, help="Where to write the import plan (default: next to the "
+                                                          "project directory). With several archives, the directory "
+                                                          "where to write their <project>-import-plan.json files.")
+    parser.add_argument('--profile', default=False, help="Profile CPU time and memory allocations of every stage of "
+                                                         "the import.")
+    parser.add_argument('--profile_path', default=None, help="Where to write the stage profiles and their summary "
+                                                             "(default: a profile directory in the project "
+                                                             "directory).")
     # TODO: other options
     params, other = parser.parse_known_args(sys.argv[1:])
 
     with Cytomine(params.host, params.public_key, params.private_key) as _:
-        options = {k:v for (k,v) in vars(params).items() if k.startswith('without')}
-
-        if params.project_path.startswith("http://") or params.project_path.startswith("https://"):
-            logging.info("Downloading from {}".format(params.project_path))
-            response = requests.get(params.project_path, allow_redirects=True, stream=True)
-            params.project_path = params.project_path[params.project_path.rfind("/") + 1 :]
-            with open(params.project_path, "wb") as f:
-                shutil.copyfileobj(response.raw, f)
-                logging.info("Downloaded successfully.")
-
-        if params.project_path.endswith(".tar.gz"):
-            tar = tarfile.open(params.project_path, "r:gz")
-            tar.extractall(os.path.dirname(params.project_path))
-            tar.close()
-            params.project_path = params.project_path[:-7]
-        elif params.project_path.endswith(".tar"):
-            tar = tarfile.open(params.project_path, "r:")
-            tar.extractall(os.path.dirname(params.project_path))
-            tar.close()
-            params.project_path = params.project_path[:-4]
-
-        importer = Importer(params.host_upload, params.project_path, **options)
-        importer.run()
\ No newline at end of file
+        options = {k:v for (k,v) in vars(params).items() if k.startswith('without')
+                   or k in ('max_retries', 'retry_delay', 'max_connections', 'max_request_rate', 'stage_limits',
+                            'profile', 'profile_path', 'annotation_max_in_memory')}
+
+        super_admin = Cytomine.get_instance().current_user
+
+        items = expand_items(params.project_path)
+
+        def _import(project_path):
+            try:
+                importer = Importer(params.host_upload, fetch_archive(project_path), **options)
+                if params.plan:
+                    plan_path = params.plan_path
+                    if plan_path and len(items) > 1:
+                        # One plan per archive, they would overwrite each other in a single file.
+                        if not os.path.exists(plan_path):
+                            os.makedirs(plan_path)
+                        project_directory = os.path.basename(os.path.normpath(importer.working_path))
+                        plan_path = os.path.join(plan_path, "{}-import-plan.json".format(project_directory))
+                    importer.plan(plan_path)
+                else:
+                    try:
+                        importer.run()
+                    finally:
+                        importer.profiler.close()
+            finally:
+                # SWITCH back to admin for the next archive, whatever stage the import stopped at
+                connect_as(super_admin, True)
+
+        failures = run_batch("import", items, _import)
+
+    sys.exit(1 if len(failures) > 0 else 0)
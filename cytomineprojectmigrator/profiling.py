@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+_lock = threading.Lock()
+_active = None
+_workers = threading.local()
+
+
+def profiled(fn):
+    """
+    Wrap a function called by worker threads so that, while a stage is profiled, the work done in the workers is
+    profiled too (one cProfile profile per worker thread, merged into the profile of the stage).
+    """
+    @functools.wraps(fn)
+    def _profiled(*args, **kwargs):
+        profiler = _active
+        if profiler is None or sys.getprofile() is not None:
+            return fn(*args, **kwargs)
+        worker = profiler._enter_worker()
+        if worker is None:
+            return fn(*args, **kwargs)
+        try:
+            worker["profile"].enable()
+        except ValueError:
+            # Another profiler is already active (Python 3.12+ only allows one at once).
+            profiler._leave_worker(worker)
+            return fn(*args, **kwargs)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            worker["profile"].disable()
+            profiler._leave_worker(worker)
+
+    return _profiled
+
+
+class StageProfiler:
+    """
+    Delimit the numbered stages of a run. When enabled (`output_path` is given), every stage is profiled with
+    cProfile and its allocations are tracked with tracemalloc. A profile dump is written per stage
+    (`NN-<stage>.prof`, to be read with pstats or snakeviz), along with a `summary.json` giving, per stage, the wall
+    and CPU time, the top functions, the top allocation sites and the memory peak.
+
+    cProfile only sees the thread running the stage: the functions run by worker threads must be wrapped with
+    `profiled` to be accounted in the stage (work still running when the stage ends is accounted in the next one).
+    tracemalloc accounts for the allocations of all threads (before Python 3.9, the memory peak of a stage is the
+    peak since profiling started).
+    """
+    def __init__(self, output_path=None, top=25):
+        self.output_path = output_path
+        self.top = top
+
+        self._stages = []
+        self._current = None
+        self._started_tracing = False
+        self._written = True
+
+    @property
+    def enabled(self):
+        return self.output_path is not None
+
+    def stage(self, name):
+        """Log the start of a stage, ending the previous one."""
+        self._end_stage()
+        logging.info(name)
+        if not self.enabled:
+            return
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+        global _active
+        profile = cProfile.Profile()
+        current = {
+            "name": name,
+            "profile": profile,
+            "workers": [],
+            "closed": False,
+            "snapshot": self._snapshot(),
+            "wall": time.time(),
+            "cpu": time.process_time()
+        }
+        with _lock:
+            self._current = current
+            _active = self
+        profile.enable()
+
+    def _enter_worker(self):
+        """Profile of the calling worker thread in the current stage, marked as running (None if no stage)."""
+        with _lock:
+            stage = self._current
+            if stage is None:
+                return None
+            worker = getattr(_workers, "worker", None)
+            if worker is None or worker["stage"] is not stage:
+                worker = {"stage": stage, "profile": cProfile.Profile(), "running": False}
+                stage["workers"].append(worker)
+                _workers.worker = worker
+            worker["running"] = True
+            return worker
+
+    def _leave_worker(self, worker):
+        with _lock:
+            worker["running"] = False
+            if worker["stage"]["closed"] and self._current is not None:
+                # The stage ended while the worker was running: its profile is accounted in the current one.
+                worker["stage"] = self._current
+                self._current["workers"].append(worker)
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")
+        ])
+
+    def _end_stage(self):
+        if self._current is None:
+            return
+        with _lock:
+            stage, self._current = self._current, None
+            stage["closed"] = True
+            workers = [worker["profile"] for worker in stage["workers"] if not worker["running"]]
+        stage["profile"].disable()
+        wall = time.time() - stage["wall"]
+        cpu = time.process_time() - stage["cpu"]
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = self._snapshot()
+
+        if not os.path.exists(self.output_path):
+            os.makedirs(self.output_path)
+        slug = re.sub(r"[^a-z0-9]+", "-", re.sub(r"^[0-9.]+/", "", stage["name"]).lower()).strip("-")
+        filename = "{:02d}-{}.prof".format(len(self._stages) + 1, slug)
+        stats = pstats.Stats(stage["profile"])
+        for profile in workers:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # Nothing recorded by this worker.
+                continue
+        stats.dump_stats(os.path.join(self.output_path, filename))
+
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top]
+        allocations = snapshot.compare_to(stage["snapshot"], "lineno")[:self.top]
+
+        self._written = False
+        self._stages.append(OrderedDict([
+            ("stage", stage["name"]),
+            ("profile", filename),
+            ("wall_time", round(wall, 3)),
+            ("cpu_time", round(cpu, 3)),
+            ("memory_current", current),
+            ("memory_peak", peak),
+            ("top_functions", [OrderedDict([
+                ("function", "{}:{}({})".format(*func)),
+                ("calls", calls),
+                ("total_time", round(total_time, 6)),
+                ("cumulative_time", round(cumulative_time, 6))
+            ]) for func, (_, calls, total_time, cumulative_time, _) in functions]),
+            ("top_allocations", [OrderedDict([
+                ("site", str(diff.traceback)),
+                ("size", diff.size_diff),
+                ("count", diff.count_diff)
+            ]) for diff in allocations])
+        ]))
+        logging.info("Stage '{}' profiled ({} worker threads): {:.1f}s wall, {:.1f}s CPU, memory peak {:.1f} MB."
+                     .format(stage["name"], len(workers), wall, cpu, peak / (1024 * 1024)))
+
+    def close(self):
+        """End the current stage and write the summary. Safe to call several times."""
+        global _active
+        self._end_stage()
+        with _lock:
+            if _active is self:
+                _active = None
+        if not self.enabled or self._written:
+            return
+
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+        summary_path = os.path.join(self.output_path, "summary.json")
+        with open(summary_path, "w") as f:
+            json.dump(OrderedDict([
+                ("wall_time", round(sum(s["wall_time"] for s in self._stages), 3)),
+                ("cpu_time", round(sum(s["cpu_time"] for s in self._stages), 3)),
+                ("memory_peak", max(s["memory_peak"] for s in self._stages)),
+                ("stages", self._stages)
+            ]), f, indent=2)
+        self._written = True
+        logging.info("Profiling summary written to {}.".format(summary_path))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+_WHITESPACE = " \t\n\r"
+
+
+def iter_json_array(path, chunk_size=1 << 16):
+    """
+    Iterate over the items of a JSON array stored in a file, parsing one item at a time.
+    Only the item being decoded (and the current read chunk) is held in memory. While an item is incomplete, the
+    read size doubles, so that an item spanning many chunks is only decoded again a logarithmic number of times.
+    """
+    decoder = json.JSONDecoder()
+    with io.open(path, "r", encoding="utf-8") as f:
+        buffer = ""
+        pos = 0
+        eof = False
+
+        def _fill(size=chunk_size):
+            chunk = f.read(size)
+            return chunk, len(chunk) == 0
+
+        # Find the opening bracket.
+        while True:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            chunk, eof = _fill()
+            buffer, pos = chunk, 0
+
+        if pos >= len(buffer):
+            return
+        if buffer[pos] != "[":
+            raise ValueError("{} does not contain a JSON array".format(path))
+        pos += 1
+
+        expect_item = True
+        read_size = chunk_size
+        while True:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+
+            if pos >= len(buffer):
+                if eof:
+                    raise ValueError("Unexpected end of file in {}".format(path))
+                chunk, eof = _fill()
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+
+            if buffer[pos] == "]":
+                return
+
+            if not expect_item:
+                if buffer[pos] != ",":
+                    raise ValueError("Malformed JSON array in {} (expected ',')".format(path))
+                pos += 1
+                expect_item = True
+                continue
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise
+                item, end = None, None
+
+            # A number (or literal) only ends at a delimiter: otherwise it may go on in the next chunk (e.g. "1" of
+            # "1.5e10"). A value ending exactly at the end of the buffer may be truncated as well.
+            if end is not None and not eof and not isinstance(item, (dict, list, str)) \
+                    and (end >= len(buffer) or buffer[end] not in _WHITESPACE + ",]"):
+                end = None
+            if end is None or (end >= len(buffer) and not eof):
+                chunk, eof = _fill(read_size)
+                read_size *= 2
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+
+            yield item
+            pos = end
+            read_size = chunk_size
+            expect_item = False
+
+
+class GroupedRecordReader:
+    """
+    Read the records of a JSON array file incrementally and yield them in batches grouped by a key (e.g. the
+    annotation creator). At most `max_in_memory` records are held in memory whatever the size of the input file:
+    beyond that, records are spilled to temporary JSON-lines files on disk, and batches are then read back from
+    disk one at a time. A file with fewer records is held in memory while its batches are processed.
+    """
+    def __init__(self, path, key="user", batch_size=1000, max_in_memory=50000, spill_path=None):
+        self.path = path
+        self.key = key
+        self.batch_size = batch_size
+        self.max_in_memory = max_in_memory
+        self.spill_path = spill_path
+
+        self._buffers = OrderedDict()
+        self._n_buffered = 0
+        self._spill_directory = None
+        self._spill_files = {}
+
+    def __iter__(self):
+        self._buffers = OrderedDict()
+        self._n_buffered = 0
+        self._spill_files = {}
+        try:
+            for record in iter_json_array(self.path):
+                key = record.get(self.key)
+                self._buffers.setdefault(key, []).append(record)
+                self._n_buffered += 1
+                if self._n_buffered >= self.max_in_memory:
+                    self._spill()
+
+            # Once something is on disk, flush everything so that only one batch is in memory while processing.
+            if self._spill_directory:
+                self._spill()
+
+            for key in list(self._buffers.keys()):
+                for batch in self._batches(key):
+                    yield key, batch
+        finally:
+            self._cleanup()
+
+    def _spill(self):
+        if not self._spill_directory:
+            self._spill_directory = tempfile.mkdtemp(prefix="migrator-spill-", dir=self.spill_path)
+            logging.info("Spilling records of {} to {}".format(self.path, self._spill_directory))
+
+        for key, records in self._buffers.items():
+            if len(records) == 0:
+                continue
+            filename = self._spill_files.get(key)
+            if not filename:
+                filename = os.path.join(self._spill_directory, "group-{}.jsonl".format(len(self._spill_files)))
+                self._spill_files[key] = filename
+            with io.open(filename, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record))
+                    f.write("\n")
+            del records[:]
+        self._n_buffered = 0
+
+    def _batches(self, key):
+        batch = []
+        filename = self._spill_files.get(key)
+        if filename:
+            with io.open(filename, "r", encoding="utf-8") as f:
+                for line in f:
+                    batch.append(json.loads(line))
+                    if len(batch) >= self.batch_size:
+                        yield batch
+                        batch = []
+
+        records = self._buffers.pop(key, [])
+        for record in records:
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _cleanup(self):
+        self._buffers = OrderedDict()
+        self._n_buffered = 0
+        self._spill_files = {}
+        if self._spill_directory:
+            shutil.rmtree(self._spill_directory, ignore_errors=True)
+            self._spill_directory = None
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+
+import requests
+from cytomine import Cytomine
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+class PermanentFailure(Exception):
+    pass
+
+
+class TransientError(Exception):
+    """A failure that may not happen again, such as an incomplete transfer: the call is worth retrying."""
+    pass
+
+
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, TransientError)
+
+# Failures after which a create request surely did not reach the application: it can be sent again.
+NOT_PROCESSED_ERRORS = (requests.exceptions.ConnectTimeout,)
+NOT_PROCESSED_STATUS = (429, 503)
+
+_responses = threading.local()
+
+
+def is_transient_status(status):
+    """Server errors, timeouts and throttling are worth retrying; other client errors will fail the same way."""
+    return status is None or status >= 500 or status in (408, 429)
+
+
+def _record_status(response, *args, **kwargs):
+    _responses.status = response.status_code
+
+
+def track_response_status():
+    """
+    Record, per thread, the HTTP status of the last response received by the Cytomine session. The client only
+    returns False on unsuccessful requests, the status tells whether it is worth retrying.
+    """
+    try:
+        hooks = Cytomine.get_instance()._session.hooks["response"]
+    except Exception:
+        return
+    if _record_status not in hooks:
+        hooks.append(_record_status)
+
+
+def last_response_status():
+    return getattr(_responses, "status", None)
+
+
+class CircuitBreaker:
+    """
+    Slow down all the callers when the server is struggling. After `failure_threshold` consecutive failures,
+    the circuit opens and every call waits for `cooldown` seconds before reaching the server again. Each new
+    failure while the circuit is open doubles the cooldown (up to `max_cooldown`); a success closes it.
+    """
+    def __init__(self, failure_threshold=5, cooldown=10, max_cooldown=300):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._cooldown = cooldown
+        self._open_until = 0
+
+    def wait(self):
+        with self._lock:
+            delay = self._open_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record_success(self):
+        with self._lock:
+            if self._failures >= self.failure_threshold:
+                logging.info("Server is responding again, circuit closed.")
+            self._failures = 0
+            self._cooldown = self.base_cooldown
+            self._open_until = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._open_until > 0:
+                    self._cooldown = min(self._cooldown * 2, self.max_cooldown)
+                self._open_until = time.time() + self._cooldown
+                logging.warning("{} consecutive failures, pausing requests for {}s."
+                                .format(self._failures, self._cooldown))
+
+
+class DeadLetterQueue:
+    """Append items that failed permanently to a JSON-lines file so that they can be replayed later."""
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, stage, item, error):
+        record = {
+            "stage": stage,
+            "item": item,
+            "error": str(error),
+            "time": datetime.now().isoformat()
+        }
+        with self._lock:
+            with io.open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, default=str))
+                f.write("\n")
+            self.count += 1
+
+
+class Resilience:
+    """
+    Retry layer shared by all the HTTP work of a migration. A call fails when it raises or when it returns False,
+    which is how the Cytomine client reports an unsuccessful request. Only transient failures (connection errors,
+    timeouts, server errors) are retried, with exponential backoff and full jitter; other failures (client errors
+    such as 400, 403, 404 or 409, unexpected exceptions) are permanent at once. When a governor is given, every
+    attempt respects its request rate.
+    """
+    def __init__(self, max_retries=5, base_delay=1, max_delay=60, circuit_breaker=None, dead_letter_path=None,
+                 governor=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.circuit_breaker = circuit_breaker if circuit_breaker else CircuitBreaker()
+        self.dead_letters = DeadLetterQueue(dead_letter_path) if dead_letter_path else None
+        self.governor = governor
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call `fn`, retrying on transient failures. Raise PermanentFailure on a permanent failure or once all
+        retries are exhausted. Only for idempotent requests (GET, PUT, DELETE...): see `create` for the others.
+        """
+        return self._call(fn, args, kwargs)
+
+    def create(self, fn, *args, lookup=None, **kwargs):
+        """
+        Call `fn`, a request creating an object (POST). When it times out, the server may have committed it all
+        the same, so that sending it again would create a duplicate. Before a retry, `lookup` (a function
+        returning the object if it exists, None or HTTP 404 otherwise) is called, and the existing object is returned if
+        found. Without `lookup`, the request is only retried when it surely was not processed by the server.
+        """
+        return self._call(fn, args, kwargs, create=True, lookup=lookup)
+
+    def _call(self, fn, args, kwargs, create=False, lookup=None):
+        track_response_status()
+        name = getattr(fn, "__name__", fn)
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                logging.warning("{} failed ({}), retry {}/{} in {:.1f}s"
+                                .format(name, error, attempt, self.max_retries, delay))
+                time.sleep(delay)
+
+                if lookup is not None:
+                    existing = self.call_optional(lookup)
+                    if existing:
+                        logging.info("{} had been committed before failing, object found: {}".format(name, existing))
+                        return existing
+
+            self.circuit_breaker.wait()
+            if self.governor:
+                self.governor.throttle()
+            _responses.status = None
+            try:
+                result = self._invoke(fn, args, kwargs)
+            except PermanentFailure:
+                raise
+            except TRANSIENT_ERRORS as e:
+                error = e
+                processed = not isinstance(e, NOT_PROCESSED_ERRORS)
+            except Exception as e:
+                raise PermanentFailure("{} failed: {}".format(name, e)) from e
+            else:
+                if result is not False:
+                    self.circuit_breaker.record_success()
+                    return result
+                status = last_response_status()
+                if not is_transient_status(status):
+                    raise PermanentFailure("{} failed (HTTP {})".format(name, status))
+                error = "HTTP {}".format(status) if status else "request unsuccessful"
+                processed = status not in NOT_PROCESSED_STATUS
+
+            if create and lookup is None and processed:
+                raise PermanentFailure("{} failed ({}) and may have been committed, not retried".format(name, error))
+
+            # Only the first failure of a call counts towards the run-wide circuit breaker: the retries of a
+            # single item do not tell that the server is struggling.
+            if attempt == 0:
+                self.circuit_breaker.record_failure()
+
+        raise PermanentFailure("{} failed after {} retries: {}".format(name, self.max_retries, error))
+
+    def _invoke(self, fn, args, kwargs):
+        # One governor slot per attempt: backoff and circuit breaker waits do not hold any.
+        if self.governor is None:
+            return fn(*args, **kwargs)
+        with self.governor.slot():
+            return fn(*args, **kwargs)
+
+    def call_optional(self, fn, *args, **kwargs):
+        """Fetch like `call`, but return None if the object does not exist (HTTP 404)."""
+        try:
+            return self.call(fn, *args, **kwargs)
+        except PermanentFailure:
+            if last_response_status() == 404:
+                return None
+            raise
+
+    def attempt(self, stage, item, fn, *args, **kwargs):
+        """
+        Call `fn` like `call`, but do not stop the migration on permanent failure: `item` is recorded in the
+        dead-letter file for the given `stage` and None is returned.
+        """
+        return self.dead_letter_on_failure(stage, item, self.call, fn, *args, **kwargs)
+
+    def attempt_create(self, stage, item, fn, *args, lookup=None, **kwargs):
+        """Call `fn` like `create`, recording `item` in the dead-letter file on permanent failure."""
+        return self.dead_letter_on_failure(stage, item, self.create, fn, *args, lookup=lookup, **kwargs)
+
+    def dead_letter_on_failure(self, stage, item, fn, *args, **kwargs):
+        """
+        Call `fn` once, recording `item` in the dead-letter file for the given `stage` (and returning None) if it
+        fails permanently. To be used on functions retrying their own requests.
+        """
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            logging.error("[{}] {}".format(stage, e))
+            if self.dead_letters is None:
+                raise
+            self.dead_letters.add(stage, item, e)
+            return None
+
+    def report(self):
+        if self.dead_letters and self.dead_letters.count > 0:
+            logging.warning("{} items failed permanently and have been written to {}"
+                            .format(self.dead_letters.count, self.dead_letters.path))
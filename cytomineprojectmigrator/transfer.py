@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cytomine import Cytomine
+from cytomine.cytomine import CytomineAuth
+
+from cytomineprojectmigrator.governor import Governor
+from cytomineprojectmigrator.profiling import profiled
+from cytomineprojectmigrator.resilience import PermanentFailure, Resilience, TransientError, is_transient_status
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+class TransferError(TransientError):
+    pass
+
+
+class TransferCancelled(PermanentFailure):
+    pass
+
+
+def _check_cancelled(cancel, url):
+    if cancel is not None and cancel.is_set():
+        raise TransferCancelled("Download of {} cancelled".format(url))
+
+
+def _status_error(message, status):
+    """Error for an unexpected HTTP status: client errors are permanent, the others are worth a retry."""
+    return TransferError(message) if is_transient_status(status) else PermanentFailure(message)
+
+
+def file_md5(path, block_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _expected_md5(headers):
+    """Extract an MD5 checksum (hex) from the response headers, if the server provides one."""
+    if headers.get("Content-MD5"):
+        return base64.b64decode(headers["Content-MD5"]).hex()
+    for digest in headers.get("Digest", "").split(","):
+        algorithm, _, value = digest.strip().partition("=")
+        if algorithm.lower() == "md5" and value:
+            return base64.b64decode(value).hex()
+    return None
+
+
+class ImageTransfer:
+    """
+    Download engine for large files. Files bigger than `min_ranged_size` are split into HTTP Range chunks that
+    are downloaded in parallel. Progress is recorded next to the partial file so that an interrupted transfer
+    resumes where it stopped, also in a later run as long as the partial file is kept at the same place. Every
+    request holds a slot of the governor "download" stage (until its body has been read), so that the number of
+    requests in flight is bounded for the whole run, whatever the number of files downloaded simultaneously. A download is stopped (raising TransferCancelled, the partial file being kept) within
+    a block of `block_size` bytes once its `cancel` event is set.
+    """
+    def __init__(self, chunk_size=64 * 1024 * 1024, min_ranged_size=128 * 1024 * 1024, resilience=None,
+                 governor=None, timeout=300, block_size=1024 * 1024):
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self.min_ranged_size = min_ranged_size
+        self.governor = governor if governor else Governor()
+        self.resilience = resilience if resilience else Resilience(governor=self.governor)
+        self.timeout = timeout
+
+    @property
+    def max_connections(self):
+        return self.governor.workers("download")
+
+    def download_image(self, image, destination, override=False, parent=True, partial=None, cancel=None):
+        url = "{}/{}/download".format(image.callback_identifier, image.id)
+        return self.download(url, destination, override=override, payload={"parent": parent}, partial=partial,
+                             cancel=cancel)
+
+    def download(self, url, destination, override=False, payload=None, expected_size=None, expected_md5=None,
+                 partial=None, cancel=None):
+        """
+        Download `url` to `destination`. The file is written to `partial` (by default, `destination` with a .part
+        suffix, on the same file system) until it is complete.
+        """
+        with self.governor.working_for("download"):
+            return self._download(url, destination, override, payload, expected_size, expected_md5, partial, cancel)
+
+    def _download(self, url, destination, override=False, payload=None, expected_size=None, expected_md5=None,
+                  partial=None, cancel=None):
+        if not override and os.path.exists(destination):
+            logging.info("File {} already exists, skip download.".format(destination))
+            return destination
+
+        cytomine = Cytomine.get_instance()
+        if not url.startswith("http"):
+            url = cytomine._base_url() + url
+
+        if partial is None:
+            partial = "{}.part".format(destination)
+        for directory in set([os.path.dirname(destination), os.path.dirname(partial)]):
+            if directory:
+                # Several images may be downloaded to the same directory at once.
+                os.makedirs(directory, exist_ok=True)
+
+        _check_cancelled(cancel, url)
+        size, accept_ranges, final_url, headers = self.resilience.call(self._probe, url, payload)
+        if expected_size is None:
+            expected_size = size
+        if expected_md5 is None:
+            expected_md5 = _expected_md5(headers)
+
+        if accept_ranges and size and size >= self.min_ranged_size:
+            self._download_ranged(final_url, partial, size, cancel)
+        else:
+            self._download_stream(final_url, partial, accept_ranges and size is not None, cancel)
+
+        self._verify(partial, expected_size, expected_md5)
+        os.rename(partial, destination)
+        self._remove_state(partial)
+        logging.info("File {} downloaded ({} bytes).".format(destination, os.path.getsize(destination)))
+        return destination
+
+    def _auth(self):
+        cytomine = Cytomine.get_instance()
+        return CytomineAuth(cytomine._public_key, cytomine._private_key, cytomine._base_url(), cytomine._base_path)
+
+    def _request(self, url, payload=None, headers=None, stream=True, method="GET"):
+        # Callers must hold one of the connection slots until the response body has been consumed.
+        cytomine = Cytomine.get_instance()
+        # The client headers hold the date signed by CytomineAuth.
+        request_headers = cytomine._headers()
+        if headers:
+            request_headers.update(headers)
+        return cytomine._session.request(method, url, auth=self._auth(), params=payload, headers=request_headers,
+                                         stream=stream, allow_redirects=True, timeout=self.timeout)
+
+    def _probe(self, url, payload):
+        """
+        Find the total size of the file and whether the server accepts range requests. The returned URL is the
+        final one (after redirections, query string included), used for the actual transfer.
+        """
+        with self.governor.slot("download"):
+            response = self._request(url, payload, headers={"Range": "bytes=0-0"})
+            response.close()
+
+        headers = response.headers
+        if response.status_code == 206:
+            content_range = headers.get("Content-Range", "")
+            total = content_range.rpartition("/")[2]
+            size = int(total) if total.isdigit() else None
+            # Checksum headers of a partial response do not describe the whole file.
+            return size, size is not None, response.url, {}
+        if response.status_code == 200:
+            length = headers.get("Content-Length")
+            size = int(length) if length and length.isdigit() else None
+            return size, headers.get("Accept-Ranges", "").lower() == "bytes", response.url, headers
+        raise _status_error("Cannot download {} (HTTP {})".format(url, response.status_code), response.status_code)
+
+    def _state_path(self, partial):
+        return "{}.json".format(partial)
+
+    def _load_state(self, partial, size):
+        state_path = self._state_path(partial)
+        if os.path.exists(partial) and os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            if state.get("size") == size and state.get("chunk_size") == self.chunk_size:
+                return set(state.get("done", []))
+        return set()
+
+    def _save_state(self, partial, size, done):
+        state_path = self._state_path(partial)
+        with open(state_path + ".tmp", "w") as f:
+            json.dump({"size": size, "chunk_size": self.chunk_size, "done": sorted(done)}, f)
+        os.replace(state_path + ".tmp", state_path)
+
+    def _remove_state(self, partial):
+        state_path = self._state_path(partial)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
+    def _download_ranged(self, url, partial, size, cancel=None):
+        done = self._load_state(partial, size)
+        if not os.path.exists(partial) or os.path.getsize(partial) != size:
+            done = set()
+            with open(partial, "wb") as f:
+                f.truncate(size)
+
+        chunks = [(i, start, min(start + self.chunk_size, size) - 1)
+                  for i, start in enumerate(range(0, size, self.chunk_size))]
+        pending = [c for c in chunks if c[0] not in done]
+        if done:
+            logging.info("Resuming {}: {}/{} chunks already downloaded.".format(partial, len(done), len(chunks)))
+
+        lock = threading.Lock()
+
+        @profiled
+        def _download_chunk(index, start, end):
+            _check_cancelled(cancel, url)
+            with self.governor.working_for("download"):
+                self.resilience.call(self._fetch_range, url, partial, start, end, cancel)
+            with lock:
+                done.add(index)
+                self._save_state(partial, size, done)
+
+        n_workers = max(1, min(self.max_connections, len(pending)))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_download_chunk, *chunk) for chunk in pending]
+            for future in futures:
+                future.result()
+
+    def _fetch_range(self, url, partial, start, end, cancel=None):
+        _check_cancelled(cancel, url)
+        with self.governor.slot("download"):
+            response = self._request(url, headers={"Range": "bytes={}-{}".format(start, end)})
+            try:
+                if response.status_code != 206:
+                    raise _status_error("Range request on {} failed (HTTP {})".format(url, response.status_code),
+                                        response.status_code)
+                written = 0
+                with open(partial, "r+b") as f:
+                    f.seek(start)
+                    for block in response.iter_content(chunk_size=self.block_size):
+                        _check_cancelled(cancel, url)
+                        f.write(block)
+                        written += len(block)
+            finally:
+                response.close()
+
+        if written != end - start + 1:
+            raise TransferError("Incomplete range {}-{} for {} ({} bytes)".format(start, end, url, written))
+
+    def _download_stream(self, url, partial, resumable, cancel=None):
+        def _fetch():
+            _check_cancelled(cancel, url)
+            headers = None
+            mode = "wb"
+            if resumable and os.path.exists(partial) and os.path.getsize(partial) > 0:
+                headers = {"Range": "bytes={}-".format(os.path.getsize(partial))}
+                mode = "ab"
+
+            with self.governor.slot("download"):
+                response = self._request(url, headers=headers)
+                try:
+                    if response.status_code == 200:
+                        mode = "wb"
+                    elif response.status_code == 416 and headers is not None:
+                        # The partial file is not a prefix of the file (larger than it): start over.
+                        self._discard(partial)
+                        raise TransferError("Cannot resume {} (HTTP 416)".format(partial))
+                    elif response.status_code != 206 or headers is None:
+                        raise _status_error("Cannot download {} (HTTP {})".format(url, response.status_code),
+                                            response.status_code)
+                    with open(partial, mode) as f:
+                        for block in response.iter_content(chunk_size=self.block_size):
+                            _check_cancelled(cancel, url)
+                            f.write(block)
+                finally:
+                    response.close()
+
+        self.resilience.call(_fetch)
+
+    def _discard(self, partial):
+        """Remove a partial file and its state, so that the next attempt starts over."""
+        self._remove_state(partial)
+        if os.path.exists(partial):
+            os.remove(partial)
+
+    def _verify(self, partial, expected_size, expected_md5):
+        size = os.path.getsize(partial)
+        if expected_size is not None and size != expected_size:
+            self._discard(partial)
+            raise TransferError("Size mismatch for {}: expected {} bytes, got {}".format(partial, expected_size, size))
+        if expected_md5 is not None:
+            md5 = file_md5(partial)
+            if md5 != expected_md5:
+                self._discard(partial)
+                raise TransferError("Checksum mismatch for {}: expected {}, got {}".format(partial, expected_md5, md5))
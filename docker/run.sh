@@ -23,21 +23,13 @@ if [[ $# -ne 2 ]]; then
 fi
 
 if [[ $1 == "import" ]]; then
-    if [[ ${2:(-4):4} == ".txt" ]]; then
-        IFS=$'\n' read -d '' -r -a lines < $2
-    else
-        lines=($2)
-    fi
-
-    for i in "${lines[@]}"; do
-        echo $i
-        python /app/cytomineprojectmigrator/importer.py \
-        --host $CORE_URL \
-        --host_upload $UPLOAD_URL \
-        --public_key $PUBLIC_KEY \
-        --private_key $PRIVATE_KEY \
-        --project_path $i
-    done
+    # A .txt file lists one archive per line; all the archives are imported by a single process.
+    python /app/cytomineprojectmigrator/importer.py \
+    --host $CORE_URL \
+    --host_upload $UPLOAD_URL \
+    --public_key $PUBLIC_KEY \
+    --private_key $PRIVATE_KEY \
+    --project_path $2
     echo "Finished."
 elif [[ $1 == "export" ]]; then
     echo $2
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+
+import pytest
+
+from cytomineprojectmigrator.archive import ARCHIVE_VERSION, MANIFEST, ArchiveReader, ArchiveWriter
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+def _write_archive(path, shard_size=2):
+    writer = ArchiveWriter(path, shard_size=shard_size)
+    writer.save("project", "project.json", json.dumps({"id": 1, "name": "p"}))
+    writer.save("user-annotations", "user-annotations-10.json", json.dumps([{"id": 2}, {"id": 3}]), count=2)
+    writer.append("properties", [{"id": 4}, {"id": 5}, {"id": 6}])
+    writer.append("properties", [{"id": 7}])
+    writer.append("description", [{"id": 8}])
+    writer.close()
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path)
+    _write_archive(path)
+
+    reader = ArchiveReader(path)
+    assert reader.version == ARCHIVE_VERSION
+    assert list(reader.records("project")) == [{"id": 1, "name": "p"}]
+    assert list(reader.records("user-annotations")) == [{"id": 2}, {"id": 3}]
+    assert [r["id"] for r in reader.records("properties")] == [4, 5, 6, 7]
+    assert reader.count("properties") == 4
+    assert reader.count("user-annotations") == 2
+    assert len(reader.files("properties")) == 2
+    assert all(f.endswith(".jsonl") for f in reader.files("properties"))
+    reader.verify()
+
+
+def test_manifest(tmp_path):
+    path = str(tmp_path)
+    _write_archive(path)
+
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    assert manifest["records"]["properties"]["format"] == "jsonl"
+    assert manifest["records"]["project"]["format"] == "json"
+    assert [shard["count"] for shard in manifest["records"]["properties"]["shards"]] == [2, 2]
+    assert all("sha256" in shard for record in manifest["records"].values() for shard in record["shards"])
+
+
+def test_verify_detects_corruption(tmp_path):
+    path = str(tmp_path)
+    _write_archive(path)
+    with io.open(os.path.join(path, "project.json"), "w", encoding="utf-8") as f:
+        f.write("{\"id\": 2}")
+
+    with pytest.raises(ValueError):
+        ArchiveReader(path).verify()
+
+
+def test_unsupported_version(tmp_path):
+    path = str(tmp_path)
+    with open(os.path.join(path, MANIFEST), "w") as f:
+        json.dump({"version": ARCHIVE_VERSION + 1, "records": {}}, f)
+
+    with pytest.raises(ValueError):
+        ArchiveReader(path)
+
+
+def test_archive_without_manifest(tmp_path):
+    path = str(tmp_path)
+    files = {
+        "project.json": {"id": 1},
+        "properties-1.json": [{"id": 2}],
+        "properties-2.json": [{"id": 3}, {"id": 4}],
+        "description-1.json": {"id": 5},
+    }
+    for filename, content in files.items():
+        with open(os.path.join(path, filename), "w") as f:
+            json.dump(content, f)
+    with open(os.path.join(path, "empty.json"), "w") as f:
+        f.write("  ")
+
+    reader = ArchiveReader(path)
+    assert reader.version == 1
+    assert reader.files("properties") == ["properties-1.json", "properties-2.json"]
+    assert [r["id"] for r in reader.records("properties")] == [2, 3, 4]
+    assert list(reader.records("description")) == [{"id": 5}]
+    assert list(reader.records("empty")) == []
+    assert reader.count("properties") == 3
+    reader.verify()
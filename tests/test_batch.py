@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+
+import pytest
+
+from cytomineprojectmigrator.batch import expand_items, run_batch
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+def test_expand_items(tmp_path):
+    path = os.path.join(str(tmp_path), "projects.txt")
+    with io.open(path, "w", encoding="utf-8") as f:
+        f.write("12\n\n# comment\n 13 \n")
+
+    assert expand_items(["1", path, "2"]) == ["1", "12", "13", "2"]
+    assert expand_items([]) == []
+
+
+def test_run_batch():
+    processed = []
+
+    def _process(item):
+        if item == "bad":
+            raise ValueError(item)
+        processed.append(item)
+
+    assert run_batch("test", ["a", "bad", "b"], _process) == ["bad"]
+    assert processed == ["a", "b"]
+    assert run_batch("test", [], _process) == []
+
+
+def test_run_batch_single_item_raises():
+    def _process(item):
+        raise ValueError(item)
+
+    with pytest.raises(ValueError):
+        run_batch("test", ["bad"], _process)
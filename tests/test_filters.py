@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import pytest
+
+from cytomineprojectmigrator.filters import ExportFilter, parse_list, parse_timestamp
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+class _Object:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+def test_parse_list():
+    assert parse_list(None) == []
+    assert parse_list("") == []
+    assert parse_list("1, 2,,*.svs ") == ["1", "2", "*.svs"]
+    assert parse_list([1, 2]) == [1, 2]
+
+
+def test_parse_timestamp():
+    assert parse_timestamp(None) is None
+    assert parse_timestamp("1546300800000") == 1546300800000
+    assert parse_timestamp("2019-01-01") == 1546300800000
+    assert parse_timestamp("2019-01-01T00:00:10") == 1546300810000
+    with pytest.raises(ValueError):
+        parse_timestamp("yesterday")
+
+
+def test_no_filter():
+    export_filter = ExportFilter()
+    assert not export_filter.filters_images
+    assert not export_filter.filters_annotations
+    assert export_filter.keep_image(_Object(id=1, originalFilename="a.svs"))
+    assert export_filter.annotation_parameters([1]) == {}
+    assert export_filter.keep_annotation(_Object(image=1, user=2, term=[]), [3])
+
+
+def test_keep_image():
+    export_filter = ExportFilter(images="12,*.svs")
+    assert export_filter.filters_images
+    assert export_filter.filters_annotations
+    assert export_filter.keep_image(_Object(id=12, originalFilename="a.tif"))
+    assert export_filter.keep_image(_Object(id=13, originalFilename="b.svs"))
+    assert not export_filter.keep_image(_Object(id=14, originalFilename="c.tif"))
+    assert not export_filter.keep_image(_Object(id=15))
+
+
+def test_requested_images_fetched_once():
+    calls = []
+
+    def fetch(id_image):
+        calls.append(id_image)
+        return None if id_image == 2 else _Object(id=id_image)
+
+    export_filter = ExportFilter(images="3,2,1,*.svs")
+    assert [image.id for image in export_filter.requested_images(fetch)] == [1, 3]
+    assert [image.id for image in export_filter.requested_images(fetch)] == [1, 3]
+    assert calls == [1, 2, 3]
+
+
+def test_annotation_parameters():
+    export_filter = ExportFilter(images="1", terms="5,4", annotation_users="7", created_after="2019-01-01",
+                                 created_before="1546300900000")
+    assert export_filter.annotation_parameters([1, 2]) == {
+        "images": "1,2",
+        "terms": "4,5",
+        "users": "7",
+        "afterThan": 1546300800000,
+        "beforeThan": 1546300900000
+    }
+
+
+def test_keep_annotation():
+    export_filter = ExportFilter(terms="4", annotation_users="7", updated_after="1000", updated_before="2000")
+
+    def annotation(**attributes):
+        values = dict(image=1, user=7, term=[4, 5], created=10, updated=1500)
+        values.update(attributes)
+        return _Object(**values)
+
+    assert export_filter.keep_annotation(annotation())
+    assert not export_filter.keep_annotation(annotation(term=[5]))
+    assert not export_filter.keep_annotation(annotation(term=None))
+    assert not export_filter.keep_annotation(annotation(user=8))
+    assert not export_filter.keep_annotation(annotation(updated=2500))
+    assert not export_filter.keep_annotation(annotation(updated=None))
+    assert export_filter.keep_annotation(annotation(updated="2000"))
+
+
+def test_keep_annotation_of_kept_images():
+    export_filter = ExportFilter(images="*.svs")
+    assert export_filter.keep_annotation(_Object(image=1, user=7), [1, 2])
+    assert not export_filter.keep_annotation(_Object(image=3, user=7), [1, 2])
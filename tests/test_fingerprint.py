@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import os
+
+from cytomineprojectmigrator.fingerprint import FingerprintIndex, file_digest
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+def _write(directory, filename, content):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, filename)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def _archive(tmp_path):
+    images = os.path.join(str(tmp_path), "images")
+    return {
+        "unique": _write(images, "unique.tif", b"abc"),
+        "first": _write(images, "first.tif", b"abcd"),
+        "other": _write(images, "other.tif", b"wxyz"),
+        "copy": _write(os.path.join(str(tmp_path), "imagegroups"), "copy.tif", b"abcd"),
+    }
+
+
+def test_file_digest(tmp_path):
+    path = _write(str(tmp_path), "file", b"x" * 100)
+    assert file_digest(path, block_size=7) == hashlib.sha256(b"x" * 100).hexdigest()
+
+
+def test_index_keys(tmp_path):
+    files = _archive(tmp_path)
+    index = FingerprintIndex(str(tmp_path))
+
+    assert index.key(files["unique"]) == "size-3"
+    assert index.key(files["first"]) == index.key(files["copy"])
+    assert index.key(files["first"]) != index.key(files["other"])
+    assert index.key(files["first"]) == "4-{}".format(hashlib.sha256(b"abcd").hexdigest())
+    assert index.size(files["unique"]) == 3
+    assert index.key(os.path.join(str(tmp_path), "images", "missing.tif")) is None
+
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from cytomineprojectmigrator.governor import Governor, parse_stage_limits
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+def test_parse_stage_limits():
+    assert parse_stage_limits(None) == {}
+    assert parse_stage_limits("download=4, metadata=2") == {"download": 4, "metadata": 2}
+    assert parse_stage_limits({"upload": 1}) == {"upload": 1}
+
+
+def test_default_shares_add_up_to_the_pool():
+    governor = Governor(max_in_flight=10)
+    assert governor.stage("download").limit == 5
+    assert governor.stage("upload").limit == 5
+    assert governor.stage("metadata").limit == 5
+    assert governor.stage("annotation").limit == 5
+
+
+def test_stage_limits():
+    governor = Governor(max_in_flight=10, stage_limits="download=8,annotation=20")
+    assert governor.stage("download").limit == 8
+    assert governor.stage("metadata").limit == 2
+    assert governor.stage("annotation").limit == 10
+    assert governor.workers("download") == 8
+
+
+def test_working_for():
+    governor = Governor(max_in_flight=4)
+    assert governor.current_stage() == "main"
+    with governor.working_for("metadata"):
+        assert governor.current_stage() == "metadata"
+        with governor.working_for("download"):
+            assert governor.current_stage() == "download"
+        assert governor.current_stage() == "metadata"
+    assert governor.current_stage() == "main"
+
+
+def test_slot_is_reentrant():
+    governor = Governor(max_in_flight=1)
+    with governor.working_for("metadata"):
+        with governor.slot():
+            with governor.slot():
+                pass
+    stage = governor.stage("metadata")
+    assert stage.count == 1
+    assert stage.in_flight == 0
+
+
+def test_slots_bound_requests_in_flight():
+    governor = Governor(max_in_flight=4)
+
+    def _request(_):
+        with governor.slot():
+            time.sleep(0.01)
+        return governor.current_stage()
+
+    assert governor.map("metadata", _request, range(20)) == ["metadata"] * 20
+    stage = governor.stage("metadata")
+    assert stage.count == 20
+    assert stage.peak == 2
+    assert stage.in_flight == 0
+
+
+def test_slots_shared_between_stages():
+    governor = Governor(max_in_flight=2)
+    peak = [0]
+    in_flight = [0]
+    lock = threading.Lock()
+
+    def _request(name):
+        with governor.slot(name):
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+
+    threads = [threading.Thread(target=_request, args=(name,)) for name in ["download", "metadata", "upload"] * 4]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] <= 2
+    assert governor.stage("download").peak == 1
+
+
+def test_throttle():
+    governor = Governor(max_in_flight=2, max_rate=100)
+    start = time.time()
+    for _ in range(6):
+        governor.throttle()
+    assert time.time() - start >= 0.04
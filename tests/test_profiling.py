@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import pstats
+from concurrent.futures import ThreadPoolExecutor
+
+from cytomineprojectmigrator.governor import Governor
+from cytomineprojectmigrator.profiling import StageProfiler, profiled
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+def _worker_hot_spot(n):
+    return sum(i * i for i in range(n))
+
+
+def _functions(path):
+    return set(function for _, _, function in pstats.Stats(path).stats.keys())
+
+
+def test_disabled_profiler(tmp_path):
+    profiler = StageProfiler()
+    profiler.stage("1/ Stage")
+    assert profiled(_worker_hot_spot)(10) == 285
+    profiler.close()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_stage_profiles_include_workers(tmp_path):
+    path = os.path.join(str(tmp_path), "profile")
+    profiler = StageProfiler(path)
+
+    profiler.stage("1/ Governed workers")
+    Governor(max_in_flight=4).map("metadata", _worker_hot_spot, [1000] * 8)
+    profiler.stage("2/ Other workers")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(profiled(_worker_hot_spot), [1000] * 4))
+    profiler.stage("3/ Nothing")
+    profiler.close()
+
+    assert "_worker_hot_spot" in _functions(os.path.join(path, "01-governed-workers.prof"))
+    assert "_worker_hot_spot" in _functions(os.path.join(path, "02-other-workers.prof"))
+    assert "_worker_hot_spot" not in _functions(os.path.join(path, "03-nothing.prof"))
+
+    with open(os.path.join(path, "summary.json")) as f:
+        summary = json.load(f)
+    assert [stage["stage"] for stage in summary["stages"]] == ["1/ Governed workers", "2/ Other workers",
+                                                               "3/ Nothing"]
+    assert any("_worker_hot_spot" in function["function"] for function in summary["stages"][0]["top_functions"])
+
+
+def test_profiled_outside_stages():
+    assert profiled(_worker_hot_spot)(10) == 285
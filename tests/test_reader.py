@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+
+import pytest
+
+from cytomineprojectmigrator.reader import GroupedRecordReader, iter_json_array
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+ITEMS = [1.5e10, -3, 0, True, False, None, "a, ]b", "été", {"x": [1, 2.25], "y": {}}, [0.5, []],
+         12345678901234]
+
+
+def _write(tmp_path, content, name="items.json"):
+    path = os.path.join(str(tmp_path), name)
+    with io.open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+    return path
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1 << 16])
+def test_iter_json_array(tmp_path, chunk_size):
+    path = _write(tmp_path, json.dumps(ITEMS))
+    assert list(iter_json_array(path, chunk_size=chunk_size)) == ITEMS
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 1 << 16])
+def test_iter_json_array_number_split_across_chunks(tmp_path, chunk_size):
+    path = _write(tmp_path, "[1.5e10]")
+    assert list(iter_json_array(path, chunk_size=chunk_size)) == [1.5e10]
+
+
+class _CountingFile:
+    def __init__(self, f, reads):
+        self.f = f
+        self.reads = reads
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.f.close()
+
+    def read(self, size):
+        self.reads.append(size)
+        return self.f.read(size)
+
+
+def test_iter_json_array_large_items(tmp_path, monkeypatch):
+    items = [{"location": "POLYGON(({}))".format(", ".join("{} {}".format(i, i) for i in range(20000))), "id": k}
+             for k in range(3)]
+    path = _write(tmp_path, json.dumps(items))
+    reads = []
+    original_open = io.open
+    monkeypatch.setattr(io, "open", lambda *args, **kwargs: _CountingFile(original_open(*args, **kwargs), reads))
+
+    assert list(iter_json_array(path, chunk_size=64)) == items
+    # The read size grows while an item is incomplete: a few reads per item, not one per 64 characters.
+    assert len(reads) < 3 * 20
+    assert max(reads) > 64
+
+
+@pytest.mark.parametrize("chunk_size", [1, 1 << 16])
+def test_iter_json_array_whitespace(tmp_path, chunk_size):
+    path = _write(tmp_path, "\n  [ 1 ,\n\t{\"a\" : 2} , 3 ]\n")
+    assert list(iter_json_array(path, chunk_size=chunk_size)) == [1, {"a": 2}, 3]
+
+
+@pytest.mark.parametrize("content, expected", [("[]", []), (" [ ] ", []), ("", [])])
+def test_iter_json_array_empty(tmp_path, content, expected):
+    path = _write(tmp_path, content)
+    assert list(iter_json_array(path, chunk_size=1)) == expected
+
+
+@pytest.mark.parametrize("content", ["{\"a\": 1}", "[1 2]", "[1, 2", "[1, {\"a\": }]", "[1x]"])
+def test_iter_json_array_malformed(tmp_path, content):
+    path = _write(tmp_path, content)
+    with pytest.raises(ValueError):
+        list(iter_json_array(path, chunk_size=1))
+
+
+def _records():
+    return [{"id": i, "user": i % 3} for i in range(20)]
+
+
+def _grouped(reader):
+    groups = {}
+    for key, batch in reader:
+        assert len(batch) <= reader.batch_size
+        groups.setdefault(key, []).extend(record["id"] for record in batch)
+    return groups
+
+
+def test_grouped_record_reader(tmp_path):
+    path = _write(tmp_path, json.dumps(_records()))
+    groups = _grouped(GroupedRecordReader(path, batch_size=4))
+    assert groups == {user: [i for i in range(20) if i % 3 == user] for user in range(3)}
+
+
+def test_grouped_record_reader_spills(tmp_path):
+    path = _write(tmp_path, json.dumps(_records()))
+    spill_path = os.path.join(str(tmp_path), "spill")
+    os.makedirs(spill_path)
+    reader = GroupedRecordReader(path, batch_size=4, max_in_memory=5, spill_path=spill_path)
+
+    groups = _grouped(reader)
+    assert groups == {user: [i for i in range(20) if i % 3 == user] for user in range(3)}
+    assert os.listdir(spill_path) == []
+
+
+def test_grouped_record_reader_cleans_up_when_stopped(tmp_path):
+    path = _write(tmp_path, json.dumps(_records()))
+    spill_path = os.path.join(str(tmp_path), "spill")
+    os.makedirs(spill_path)
+    iterator = iter(GroupedRecordReader(path, batch_size=2, max_in_memory=5, spill_path=spill_path))
+
+    next(iterator)
+    assert len(os.listdir(spill_path)) == 1
+    iterator.close()
+    assert os.listdir(spill_path) == []
+
+
+def test_grouped_record_reader_memory_bound(tmp_path):
+    path = _write(tmp_path, json.dumps(_records()))
+    reader = GroupedRecordReader(path, batch_size=100, max_in_memory=4, spill_path=str(tmp_path))
+
+    in_memory = []
+    for _, batch in reader:
+        in_memory.append(sum(len(records) for records in reader._buffers.values()))
+    assert max(in_memory) <= 4
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import time
+
+import pytest
+import requests
+
+from cytomineprojectmigrator import resilience as resilience_module
+from cytomineprojectmigrator.governor import Governor
+from cytomineprojectmigrator.resilience import CircuitBreaker, PermanentFailure, Resilience, TransientError
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+
+class _Server:
+    """Fake request: each call plays the next outcome (a result, an HTTP status for False, or an exception)."""
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, int):
+            resilience_module._responses.status = outcome
+            return False
+        return outcome
+
+
+def _resilience(**kwargs):
+    return Resilience(max_retries=3, base_delay=0, **kwargs)
+
+
+def test_call_success():
+    resilience = _resilience()
+    assert resilience.call(lambda a, b=0: a + b, 1, b=2) == 3
+
+
+def test_call_retries_transient_failures():
+    for failure in (503, 500, 429, 408, requests.exceptions.ConnectionError(), requests.exceptions.ReadTimeout(),
+                    TransientError()):
+        server = _Server(failure, failure, "ok")
+        assert _resilience().call(server) == "ok"
+        assert server.calls == 3
+
+
+@pytest.mark.parametrize("status", [400, 403, 404, 409])
+def test_call_does_not_retry_client_errors(status):
+    server = _Server(status, "ok")
+    with pytest.raises(PermanentFailure):
+        _resilience().call(server)
+    assert server.calls == 1
+
+
+def test_call_does_not_retry_unexpected_errors():
+    server = _Server(KeyError("id"), "ok")
+    with pytest.raises(PermanentFailure) as e:
+        _resilience().call(server)
+    assert isinstance(e.value.__cause__, KeyError)
+    assert server.calls == 1
+
+
+def test_call_gives_up_after_max_retries():
+    server = _Server(503)
+    resilience = _resilience()
+    with pytest.raises(PermanentFailure):
+        resilience.call(server)
+    assert server.calls == 4
+    # The retries of a single call count once in the circuit breaker.
+    assert resilience.circuit_breaker._failures == 1
+
+
+def test_call_optional():
+    resilience = _resilience()
+    assert resilience.call_optional(_Server(404)) is None
+    assert resilience.call_optional(_Server("ok")) == "ok"
+    with pytest.raises(PermanentFailure):
+        resilience.call_optional(_Server(403))
+
+
+def test_create_without_lookup_retried_only_when_not_processed():
+    for failure in (requests.exceptions.ConnectTimeout(), 503, 429):
+        server = _Server(failure, "created")
+        assert _resilience().create(server) == "created"
+        assert server.calls == 2
+
+    for failure in (requests.exceptions.ReadTimeout(), requests.exceptions.ConnectionError(), 500, 502):
+        server = _Server(failure, "created")
+        with pytest.raises(PermanentFailure):
+            _resilience().create(server)
+        assert server.calls == 1
+
+
+def test_create_with_lookup():
+    server = _Server(requests.exceptions.ReadTimeout(), "created")
+    assert _resilience().create(server, lookup=lambda: "existing") == "existing"
+    assert server.calls == 1
+
+    server = _Server(requests.exceptions.ReadTimeout(), "created")
+    assert _resilience().create(server, lookup=lambda: None) == "created"
+    assert server.calls == 2
+
+    server = _Server(502, "created")
+    assert _resilience().create(server, lookup=_Server(404)) == "created"
+    assert server.calls == 2
+
+
+def test_attempt_records_dead_letters(tmp_path):
+    path = os.path.join(str(tmp_path), "dead-letters.jsonl")
+    resilience = _resilience(dead_letter_path=path)
+
+    assert resilience.attempt("metadata", {"id": 1}, _Server(404)) is None
+    assert resilience.attempt_create("annotation", 2, _Server(requests.exceptions.ReadTimeout())) is None
+    assert resilience.attempt("metadata", 3, _Server("ok")) == "ok"
+    assert resilience.dead_letters.count == 2
+
+    with io.open(path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert [(r["stage"], r["item"]) for r in records] == [("metadata", {"id": 1}), ("annotation", 2)]
+
+
+def test_attempt_without_dead_letters_raises():
+    with pytest.raises(PermanentFailure):
+        _resilience().attempt("metadata", 1, _Server(404))
+
+
+def test_calls_hold_a_governor_slot():
+    governor = Governor(max_in_flight=2)
+    resilience = _resilience(governor=governor)
+    with governor.working_for("metadata"):
+        resilience.call(_Server(503, "ok"))
+    assert governor.stage("metadata").count == 2
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=100, max_cooldown=150)
+    breaker.record_failure()
+    assert breaker._open_until == 0
+
+    breaker.record_failure()
+    assert breaker._open_until > time.time() + 90
+    breaker.record_failure()
+    assert breaker._cooldown == 150
+
+    breaker.record_success()
+    assert breaker._open_until == 0
+    assert breaker._cooldown == 100
+    breaker.wait()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+# * Copyright (c) 2009-2019. Authors: see NOTICE file.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License");
+# * you may not use this file except in compliance with the License.
+# * You may obtain a copy of the License at
+# *
+# *      http://www.apache.org/licenses/LICENSE-2.0
+# *
+# * Unless required by applicable law or agreed to in writing, software
+# * distributed under the License is distributed on an "AS IS" BASIS,
+# * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# * See the License for the specific language governing permissions and
+# * limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+from cytomine import Cytomine
+
+from cytomineprojectmigrator.governor import Governor
+from cytomineprojectmigrator.resilience import PermanentFailure, Resilience
+from cytomineprojectmigrator.transfer import ImageTransfer, TransferCancelled, TransferError
+
+__author__ = "Rubens Ulysse <urubens@uliege.be>"
+
+CONTENT = bytes(bytearray(i % 251 for i in range(100000)))
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Cytomine-like server: answers the ping and current user requests of the client, and serves CONTENT at
+    `/files/ranged` (with HTTP Range support), `/files/stream` (without), `/files/slow` (without, in about 3 seconds)
+    and `/files/bad-md5` (wrong checksum).
+    Requests that are not signed are refused.
+    """
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/server/ping"):
+            return self._send(200, b"{}")
+        if self.path.startswith("/api/user/current.json"):
+            return self._send(200, json.dumps({"id": 1, "username": "test"}).encode())
+        if not self.headers.get("date") or not self.headers.get("authorization"):
+            return self._send(401)
+
+        name = self.path.split("?")[0].rpartition("/")[2]
+        byte_range = self.headers.get("Range")
+        _Handler.requests.append((name, byte_range))
+        if name not in ("ranged", "stream", "slow", "bad-md5"):
+            return self._send(404)
+
+        if name == "slow":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(CONTENT)))
+            self.end_headers()
+            for start in range(0, len(CONTENT), 1000):
+                self.wfile.write(CONTENT[start:start + 1000])
+                self.wfile.flush()
+                time.sleep(0.03)
+            return
+
+        if name == "ranged" and byte_range:
+            start, end = re.match(r"bytes=(\d+)-(\d*)", byte_range).groups()
+            start, end = int(start), min(int(end) if end else len(CONTENT) - 1, len(CONTENT) - 1)
+            if start >= len(CONTENT):
+                return self._send(416, headers={"Content-Range": "bytes */{}".format(len(CONTENT))})
+            return self._send(206, CONTENT[start:end + 1],
+                              {"Content-Range": "bytes {}-{}/{}".format(start, end, len(CONTENT))})
+
+        headers = {"Accept-Ranges": "bytes" if name == "ranged" else "none"}
+        md5 = hashlib.md5(CONTENT if name != "bad-md5" else b"other").digest()
+        headers["Content-MD5"] = base64.b64encode(md5).decode()
+        return self._send(200, CONTENT, headers)
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = _Server(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}".format(httpd.server_address[1])
+    Cytomine(url, "public", "private", use_cache=False, configure_logging=False)
+    yield url
+    httpd.shutdown()
+
+
+@pytest.fixture
+def transfer(server):
+    del _Handler.requests[:]
+    governor = Governor(max_in_flight=4)
+    resilience = Resilience(max_retries=2, base_delay=0, governor=governor)
+    return ImageTransfer(chunk_size=30000, min_ranged_size=50000, resilience=resilience, governor=governor)
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_ranged_download(server, transfer, tmp_path):
+    destination = os.path.join(str(tmp_path), "image.tif")
+    assert transfer.download(server + "/files/ranged", destination) == destination
+
+    assert _read(destination) == CONTENT
+    assert not os.path.exists(destination + ".part")
+    assert not os.path.exists(destination + ".part.json")
+    ranges = sorted(r for _, r in _Handler.requests[1:])
+    assert ranges == ["bytes=0-29999", "bytes=30000-59999", "bytes=60000-89999", "bytes=90000-99999"]
+
+
+def test_ranged_download_resumes(server, transfer, tmp_path):
+    destination = os.path.join(str(tmp_path), "image.tif")
+    with open(destination + ".part", "wb") as f:
+        f.write(CONTENT[:60000] + b"\0" * 40000)
+    with open(destination + ".part.json", "w") as f:
+        json.dump({"size": len(CONTENT), "chunk_size": 30000, "done": [0, 1]}, f)
+
+    transfer.download(server + "/files/ranged", destination)
+    assert _read(destination) == CONTENT
+    assert sorted(r for _, r in _Handler.requests[1:]) == ["bytes=60000-89999", "bytes=90000-99999"]
+
+
+def test_stream_download(server, transfer, tmp_path):
+    destination = os.path.join(str(tmp_path), "image.tif")
+    transfer.download(server + "/files/stream", destination)
+    assert _read(destination) == CONTENT
+    assert [r for _, r in _Handler.requests[1:]] == [None]
+
+
+def test_stream_download_resumes(server, transfer, tmp_path):
+    transfer.min_ranged_size = len(CONTENT) + 1
+    destination = os.path.join(str(tmp_path), "image.tif")
+    with open(destination + ".part", "wb") as f:
+        f.write(CONTENT[:12345])
+
+    transfer.download(server + "/files/ranged", destination)
+    assert _read(destination) == CONTENT
+    assert [r for _, r in _Handler.requests[1:]] == ["bytes=12345-"]
+
+
+def test_stream_download_restarts_when_partial_too_large(server, transfer, tmp_path):
+    transfer.min_ranged_size = len(CONTENT) + 1
+    destination = os.path.join(str(tmp_path), "image.tif")
+    with open(destination + ".part", "wb") as f:
+        f.write(CONTENT + b"extra")
+
+    transfer.download(server + "/files/ranged", destination)
+    assert _read(destination) == CONTENT
+    assert [r for _, r in _Handler.requests[1:]] == ["bytes=100005-", None]
+
+
+def test_missing_file_is_not_retried(server, transfer, tmp_path):
+    with pytest.raises(PermanentFailure):
+        transfer.download(server + "/files/missing", os.path.join(str(tmp_path), "image.tif"))
+    assert len(_Handler.requests) == 1
+
+
+def test_checksum_mismatch(server, transfer, tmp_path):
+    destination = os.path.join(str(tmp_path), "image.tif")
+    with pytest.raises(TransferError):
+        transfer.download(server + "/files/bad-md5", destination)
+    assert not os.path.exists(destination)
+    assert not os.path.exists(destination + ".part")
+
+
+def test_existing_file_is_not_downloaded(server, transfer, tmp_path):
+    destination = os.path.join(str(tmp_path), "image.tif")
+    with open(destination, "wb") as f:
+        f.write(b"done")
+    transfer.download(server + "/files/ranged", destination)
+    assert _read(destination) == b"done"
+    assert _Handler.requests == []
+
+
+def test_download_resumes_partial_file_kept_elsewhere(server, transfer, tmp_path):
+    transfer.min_ranged_size = len(CONTENT) + 1
+    partial = os.path.join(str(tmp_path), "partial-downloads", "1-image.tif.part")
+    os.makedirs(os.path.dirname(partial))
+    with open(partial, "wb") as f:
+        f.write(CONTENT[:50000])
+
+    destination = os.path.join(str(tmp_path), "project", "images", "image.tif")
+    transfer.download(server + "/files/ranged", destination, partial=partial)
+    assert _read(destination) == CONTENT
+    assert not os.path.exists(partial)
+    assert [r for _, r in _Handler.requests[1:]] == ["bytes=50000-"]
+
+
+def test_cancelled_before_start(server, transfer, tmp_path):
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(TransferCancelled):
+        transfer.download(server + "/files/ranged", os.path.join(str(tmp_path), "image.tif"), cancel=cancel)
+    assert _Handler.requests == []
+
+
+def test_cancelled_while_downloading(server, transfer, tmp_path):
+    transfer.block_size = 1000
+    destination = os.path.join(str(tmp_path), "image.tif")
+    cancel = threading.Event()
+    timer = threading.Timer(0.3, cancel.set)
+    timer.start()
+
+    start = time.time()
+    with pytest.raises(TransferCancelled):
+        transfer.download(server + "/files/slow", destination, cancel=cancel)
+    assert time.time() - start < 1.5
+    assert not os.path.exists(destination)
+    assert 0 < os.path.getsize(destination + ".part") < len(CONTENT)